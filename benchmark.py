@@ -0,0 +1,721 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for nyc_restaurant_grades.
+
+The App Engine SDK needs to be on the PYTHONPATH, e.g.
+
+    PYTHONPATH=$SDK:$SDK/lib/webapp2-2.5.2:$SDK/lib/jinja2-2.6 \\
+        python benchmark.py [--restaurants=28000] [--fixtures=DIR]
+
+Fixtures are generated in the same format as the DoH DWR responses,
+so nothing here touches the network.  Real responses for the
+pipeline benchmark can be recorded once with --record=DIR and then
+replayed with --fixtures=DIR.
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import BaseHTTPServer
+import cPickle as pickle
+import glob
+import gzip
+import optparse
+import os
+import random
+import re
+import resource
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import zlib
+from datetime import date, datetime
+from StringIO import StringIO
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+import nyc_restaurant_grades as nrg
+
+# -------------------------------------------------------------------
+# Fixtures
+#
+
+CUISINES = ['American ', 'Chinese', 'Pizza', 'Italian', 'Mexican',
+            'Japanese', 'Caf\\u00e9/Coffee/Tea', 'Bakery',
+            'Ice Cream, Gelato, Yogurt, Ices']
+STREETS = ['BROADWAY', '8 AVENUE', 'WEST   34 STREET', 'COURT STREET',
+           'ATLANTIC AVENUE', 'MAIN STREET']
+GRADES = ['A', 'A', 'A', 'B', 'C', '']
+
+# Fields the DoH site sends that we don't use.
+EXTRA_FIELDS = ['building', 'phone', 'violationCode',
+                'inspectionType', 'gradeDate', 'displayOrder']
+
+def make_dwr_response(count, zipcodes=None, seed=0, first_camis=40000000):
+    """
+    Build a fake DWR response describing count restaurants, numbered
+    from first_camis.
+    """
+    rng = random.Random(seed)
+    if zipcodes is None:
+        zipcodes = range(10001, 10300) + range(11201, 11440)
+    out = ["//#DWR-INSERT\r\n//#DWR-REPLY\r\n"]
+    out.append("".join("var s%d={};" % i for i in range(count)))
+    for i in range(count):
+        fields = [
+            ('restCamis', '"%d"' % (first_camis + i)),
+            ('restaurantName', '"RESTAURANT %d"' % i),
+            ('restZipCode', '"%d"' % rng.choice(zipcodes)),
+            ('brghCode', '"%d"' % rng.randint(1, 5)),
+            ('stName', '"%s"' % rng.choice(STREETS)),
+            ('cuisineType', '"%s"' % rng.choice(CUISINES)),
+            ('restCurrentGrade', '"%s"' % rng.choice(GRADES)),
+            ('scoreViolations', '"%d"' % rng.randint(0, 60)),
+            ('lastInspectedDate', '"%02d/%02d/%d"' %
+             (rng.randint(1, 12), rng.randint(1, 28),
+              rng.randint(2010, 2013))),
+            ]
+        fields.extend((f, '"%d"' % rng.randint(0, 99999))
+                      for f in EXTRA_FIELDS)
+        out.append("".join("s%d.%s=%s;" % (i, f, v) for (f, v) in fields))
+        out.append("\r\n")
+    out.append("dwr.engine._remoteHandleCallback('0','0',[%s]);\r\n" %
+               ",".join("s%d" % i for i in range(count)))
+    return "".join(out)
+
+def revise_response(response, fraction, seed=0):
+    """
+    A later version of a DWR response, in which fraction of the
+    restaurants have a new score.
+    """
+    rng = random.Random(seed)
+    def rescore(match):
+        if rng.random() >= fraction:
+            return match.group(0)
+        return '%s"%d"' % (match.group(1), int(match.group(2)) + 1)
+    return re.sub(r'(scoreViolations=)"(\d+)"', rescore, response)
+
+# Zipcodes of the pipeline fixtures: Battery Park City has a handful
+# of restaurants, Times Square more than any other zipcode.
+SMALL_ZIPCODE = 10280
+DENSE_ZIPCODE = 10036
+
+def synthetic_fixture(zipcodes, per_zipcode):
+    """
+    A dict of zipcode to generated DWR response, with distinct
+    camis across zipcodes.
+    """
+    return dict((zipcode, make_dwr_response(
+                    per_zipcode, zipcodes=[zipcode], seed=zipcode,
+                    first_camis=40000000 + i * per_zipcode))
+                for i, zipcode in enumerate(zipcodes))
+
+def record_fixtures(directory, zipcodes):
+    """
+    Save the DoH site's current response for each zipcode in
+    directory.
+    """
+    for zipcode in zipcodes:
+        url, params = nrg.search_params(zipcode=zipcode)
+        with open(os.path.join(directory, '%d.dwr' % zipcode), 'wb') as f:
+            f.write(nrg.read_url(url, params))
+
+def load_fixtures(directory):
+    """
+    The recorded responses in directory, as a dict of zipcode to
+    response.
+    """
+    fixtures = {}
+    for path in glob.glob(os.path.join(directory or '', '*.dwr')):
+        with open(path, 'rb') as f:
+            fixtures[int(os.path.basename(path)[:-4])] = f.read()
+    return fixtures
+
+def pipeline_fixtures(directory, restaurants):
+    """
+    The fixtures for the pipeline benchmark: recorded responses for
+    one small and one dense zipcode where we have them, generated
+    ones otherwise, and a generated citywide set.
+    """
+    recorded = load_fixtures(directory)
+    fixtures = []
+    for label, zipcode, count in [('small zipcode', SMALL_ZIPCODE, 40),
+                                  ('dense zipcode', DENSE_ZIPCODE, 1200)]:
+        if zipcode in recorded:
+            fixtures.append(('%s (recorded)' % label,
+                             {zipcode: recorded[zipcode]}))
+        else:
+            fixtures.append(('%s (synthetic)' % label,
+                             synthetic_fixture([zipcode], count)))
+    zipcodes = range(10001, 10300) + range(11201, 11440)
+    fixtures.append(('citywide (synthetic)', synthetic_fixture(
+        zipcodes, max(1, restaurants // len(zipcodes)))))
+    return fixtures
+
+# -------------------------------------------------------------------
+# Reference implementations
+#
+
+def legacy_parse_javascript(results):
+    """
+    The original parser: materialize, split, and grow a list of
+    dicts holding every field.
+    """
+    pattern = re.compile(r"^s(\d+)\.(\w+)=(.+)$")
+    lines = results.replace("\r\n", "").split(";")
+    restaurants = []
+    for line in lines:
+        m = pattern.match(line)
+        if m:
+            key, field, val = m.groups()
+            key = int(key)
+            if key >= len(restaurants):
+                restaurants.extend({}
+                                   for i in range(key - len(restaurants) + 1))
+            restaurants[key][field] = val.strip('"')
+    return restaurants
+
+def legacy_normalize(restaurants):
+    """
+    The original find_restaurants normalization: copy seven fields
+    into new keys on each raw dict.
+    """
+    for rest_hash in restaurants:
+        rest_hash['camis']   = rest_hash['restCamis']
+        rest_hash['name']    = rest_hash['restaurantName']
+        rest_hash['zipcode'] = int(rest_hash['restZipCode'])
+        rest_hash['street']  = rest_hash['stName']
+        rest_hash['cuisine'] = rest_hash['cuisineType']
+        rest_hash['grade']   = rest_hash['restCurrentGrade']
+        rest_hash['score']   = int(rest_hash['scoreViolations'])
+        (month, day, year) = rest_hash['lastInspectedDate'].split('/')
+        rest_hash['last_inspected'] = date(int(year), int(month), int(day))
+    return restaurants
+
+class FakeKey(object):
+    def __init__(self, name):
+        self.name = name
+
+    def id_or_name(self):
+        return self.name
+
+class FakeRestaurant(object):
+    """
+    Stands in for a stored Restaurant entity.
+    """
+    def __init__(self, record):
+        self._key = FakeKey(record.camis)
+        self.grade = record.grade
+        self.score = record.score
+        self.last_inspected = record.last_inspected
+
+    def key(self):
+        return self._key
+
+class LegacyRestaurantRecord(object):
+    """
+    RestaurantRecord before dictionary encoding: every field holds
+    the value parsed for it.
+    """
+    FIELDS = nrg.RestaurantRecord.FIELDS + ('borough',)
+    __slots__ = FIELDS
+
+    def __init__(self, fields):
+        (month, day, year) = fields['lastInspectedDate'].split('/')
+        self.camis   = fields['restCamis']
+        self.name    = fields['restaurantName']
+        self.zipcode = int(fields['restZipCode'])
+        self.street  = fields['stName']
+        self.cuisine = fields['cuisineType']
+        self.grade   = fields['restCurrentGrade']
+        self.borough = fields['brghCode']
+        self.score   = int(fields['scoreViolations'])
+        self.last_inspected = date(int(year), int(month), int(day))
+
+def legacy_snapshot_dumps(restaurants, fetched):
+    """
+    The original snapshot format: a compressed pickle of every row.
+    """
+    rows = [tuple(getattr(r, f) for f in nrg.RestaurantRecord.FIELDS)
+            for r in restaurants]
+    return zlib.compress(pickle.dumps((fetched, rows),
+                                      pickle.HIGHEST_PROTOCOL))
+
+def legacy_snapshot_search(blob):
+    """
+    Load an original snapshot and answer one search, which builds
+    the index.
+    """
+    fetched, rows = pickle.loads(zlib.decompress(blob))
+    snapshot = nrg.RestaurantSnapshot(
+        [nrg.RestaurantRecord(*row) for row in rows], fetched)
+    return snapshot.index.search(name='restaurant 1', limit=100)[1]
+
+def legacy_match(restaurants, updates):
+    """
+    The original update_restaurants matching: scan every stored
+    restaurant for every update.
+    """
+    matched = []
+    for update in updates:
+        matches = [r for r in restaurants
+                   if r.key().id_or_name() == update.camis]
+        if len(matches) == 1:
+            matched.append((matches[0], update))
+    return matched
+
+# -------------------------------------------------------------------
+# Fake DoH site
+#
+
+class FakeDohHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers getResultsSrchCriteria POSTs with a generated response
+    for the requested zipcode, after server.latency seconds.
+    Connections are kept alive, and responses gzipped if asked.
+
+    Failures can be injected by putting them on server.faults, each
+    taking the next request:
+
+     - 'error': answer with HTTP 500,
+     - 'stall': send half the body, then stall for server.stall
+       seconds and close the connection,
+     - 'close': answer, then close the connection without saying so,
+       as a site dropping idle keep-alive connections does.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        params = urlparse.parse_qs(
+            self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests += 1
+            fault = self.server.faults.pop(0) if self.server.faults else None
+        match = re.search(r"zipCode :_(\d+)", params['c0-param0'][0])
+        zipcode = int(match.group(1)) if match else 10001
+        time.sleep(self.server.latency)
+        if fault == 'error':
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = make_dwr_response(self.server.per_zipcode, zipcodes=[zipcode],
+                                 seed=zipcode)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/javascript')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            out = StringIO()
+            with gzip.GzipFile(fileobj=out, mode='wb') as f:
+                f.write(body)
+            body = out.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+            with self.server.lock:
+                self.server.gzipped += 1
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if fault == 'stall':
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            time.sleep(self.server.stall)
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+        if fault == 'close':
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+class FakeDohServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, per_zipcode, stall=1.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeDohHandler)
+        self.latency = latency
+        self.per_zipcode = per_zipcode
+        self.stall = stall
+        self.faults = []
+        self.lock = threading.Lock()
+        # Connections accepted, requests answered, and responses
+        # gzipped so far.
+        self.connections = 0
+        self.requests = 0
+        self.gzipped = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def fetch(self, zipcode=None):
+        """
+        Like fetch_restaurants, but against this server.
+        """
+        params = {'c0-param0': 'string:zipCode :_%s' % zipcode}
+        return [nrg.RestaurantRecord.from_dwr(fields)
+                for fields in nrg.read_url(self.url, params, tohash=True,
+                                           fields=nrg.DWR_FIELDS)]
+
+class ReplayDohClient(nrg.DohClient):
+    """
+    A DohClient that answers searches from a dict of recorded
+    responses by zipcode instead of the network.  The responses
+    aren't paged, so the first page of a citywide search gets all of
+    them and later pages get none.
+    """
+    def __init__(self, responses):
+        nrg.DohClient.__init__(self)
+        self.responses = responses
+
+    def request(self, url, data):
+        params = urlparse.parse_qs(data)
+        match = re.search(r"zipCode :_(\d+)", params['c0-param0'][0])
+        if match is None:
+            if params['c0-param3'][0] != 'number:1':
+                return StringIO('')
+            return StringIO(''.join(self.responses.values()))
+        if int(match.group(1)) not in self.responses:
+            raise nrg.DohError('%s: no recorded response' % url)
+        return StringIO(self.responses[int(match.group(1))])
+
+# -------------------------------------------------------------------
+# Fake datastore
+#
+
+class FakeAppEngine(object):
+    """
+    Datastore, memcache, mail and task queue stubs from the SDK's
+    testbed, with every RPC counted by nrg.stats.
+    """
+    def __enter__(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_taskqueue_stub()
+        self.testbed.init_user_stub()
+        # The testbed brings its own API proxy, so hook it again.
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'stats', nrg.count_rpc)
+        nrg.stats.enabled = True
+        return self
+
+    def __exit__(self, *exc_info):
+        self.testbed.deactivate()
+        return False
+
+# -------------------------------------------------------------------
+# Measurement
+#
+
+def measure(func, *args):
+    """
+    Run func in a forked child so that its peak memory can be
+    measured on its own.  Returns (seconds, peak rss in KB, result
+    length).
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+        os.write(write_fd, "%r %r %r" % (elapsed, peak, len(result)))
+        os._exit(0)
+    os.close(write_fd)
+    data = os.read(read_fd, 1024)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    elapsed, peak, length = data.split()
+    return float(elapsed), int(peak), int(length)
+
+class Stage(object):
+    """
+    Times one stage of a pipeline run, and collects the RPCs it made.
+    ru_maxrss only grows, so peak is how much a stage raised the
+    process's high-water mark.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+
+    def __enter__(self):
+        self.collector = nrg.stats.start(self.name)
+        self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+        self.peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                     self.rss)
+        nrg.stats.bind(None)
+        return False
+
+    def rpcs(self):
+        return sum(n for name, n in self.collector.counters.items()
+                   if name.startswith('rpc.'))
+
+    def line(self):
+        rate = self.items / self.seconds if self.seconds else 0
+        return "  %-12s %8.3fs %10.0f/s %8dKB %6d RPCs %8d items" % (
+            self.name, self.seconds, rate, self.peak, self.rpcs(), self.items)
+
+def in_child(func, *args):
+    """
+    Run func in a forked child, and return the lines it prints as a
+    list.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            output = "\n".join(func(*args))
+        except Exception as e:
+            output = "  failed: %r" % e
+        os.write(write_fd, output)
+        os._exit(0)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return "".join(chunks).split("\n")
+
+def deep_size(records, fields):
+    """
+    Bytes held by records and the distinct objects in their fields.
+    """
+    seen = set()
+    total = 0
+    for record in records:
+        total += sys.getsizeof(record)
+        for field in fields:
+            value = getattr(record, field)
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+def report(label, func, *args):
+    elapsed, peak, length = measure(func, *args)
+    print "%-40s %8.3fs %10dKB %8d items" % (label, elapsed, peak, length)
+
+# -------------------------------------------------------------------
+# Benchmarks
+#
+
+def bench_parse(response):
+    print "== parse"
+    report("legacy parse_javascript", legacy_parse_javascript, response)
+    report("iter_restaurants (all fields)",
+           lambda r: list(nrg.iter_restaurants(StringIO(r))), response)
+    report("iter_restaurants (DWR_FIELDS)",
+           lambda r: list(nrg.iter_restaurants(StringIO(r),
+                                               fields=nrg.DWR_FIELDS)),
+           response)
+
+def bench_records(response):
+    print "== parse + normalize"
+    report("legacy dicts",
+           lambda r: legacy_normalize(legacy_parse_javascript(r)), response)
+    report("RestaurantRecord",
+           lambda r: [nrg.RestaurantRecord.from_dwr(fields)
+                      for fields in nrg.iter_restaurants(
+                          StringIO(r), fields=nrg.DWR_FIELDS)],
+           response)
+
+def bench_reconcile(sizes):
+    print "== reconcile one zipcode"
+    for size in sizes:
+        updates = [nrg.RestaurantRecord.from_dwr(fields)
+                   for fields in nrg.iter_restaurants(
+                       StringIO(make_dwr_response(size, zipcodes=[10036])))]
+        stored = [FakeRestaurant(r) for r in updates]
+        report("legacy scan, %d restaurants" % size,
+               legacy_match, stored, updates)
+        report("reconcile, %d restaurants" % size,
+               lambda s, u: nrg.reconcile(s, u)[1], stored, updates)
+
+def bench_snapshot(response):
+    print "== load snapshot and search"
+    records = [nrg.RestaurantRecord.from_dwr(fields)
+               for fields in nrg.iter_restaurants(StringIO(response),
+                                                  fields=nrg.DWR_FIELDS)]
+    fetched = datetime.now()
+    legacy = legacy_snapshot_dumps(records, fetched)
+    blob = nrg.RestaurantSnapshot(records, fetched).dumps()
+    print "pickle: %d bytes, mapped: %d bytes" % (len(legacy), len(blob))
+    report("legacy pickle", legacy_snapshot_search, legacy)
+    report("mapped",
+           lambda b: nrg.RestaurantSnapshot.loads(b).index.search(
+               name='restaurant 1', limit=100)[1],
+           blob)
+
+def bench_memory(response):
+    print "== citywide records in memory"
+    def legacy(r):
+        return [LegacyRestaurantRecord(fields)
+                for fields in nrg.iter_restaurants(StringIO(r),
+                                                   fields=nrg.DWR_FIELDS)]
+    def encoded(r):
+        return [nrg.RestaurantRecord.from_dwr(fields)
+                for fields in nrg.iter_restaurants(StringIO(r),
+                                                   fields=nrg.DWR_FIELDS)]
+    report("plain strings", legacy, response)
+    report("dictionary-encoded", encoded, response)
+    before = deep_size(legacy(response), LegacyRestaurantRecord.FIELDS)
+    records = encoded(response)
+    after = deep_size(records, nrg.RestaurantRecord.__slots__)
+    tables = sum(sys.getsizeof(codebook.values) + sys.getsizeof(codebook.codes)
+                 for codebook in nrg.CODED_FIELDS.values())
+    print "plain strings: %d bytes, dictionary-encoded: %d bytes" % (
+        before, after)
+    print "code tables: %d bytes for %s distinct values" % (
+        tables, ", ".join("%d %s" % (len(codebook), field)
+                          for field, codebook in nrg.CODED_FIELDS.items()))
+
+def bench_fetch(zipcodes, latency, parallelisms):
+    print "== fetch %d zipcodes, %.2fs latency" % (zipcodes, latency)
+    server = FakeDohServer(latency, per_zipcode=50)
+    limiter = nrg.RateLimiter(0)
+    for parallelism in parallelisms:
+        report("fetch_zipcodes, parallelism %d" % parallelism,
+               lambda: list(nrg.fetch_zipcodes(
+                   range(10001, 10001 + zipcodes), fetch=server.fetch,
+                   parallelism=parallelism, limiter=limiter)))
+    server.shutdown()
+
+# Users subscribed to the fixture's restaurants in the pipeline
+# benchmark, and how many restaurants each subscribes to.
+PIPELINE_USERS = 50
+SUBSCRIPTIONS_PER_USER = 20
+
+def run_pipeline(fixture):
+    """
+    Parse, normalize, search, subscribe, update and notify for one
+    fixture against the fake datastore.  Returns report lines.
+    """
+    revised = dict((zipcode, revise_response(response, 0.2, zipcode))
+                   for zipcode, response in fixture.items())
+    nrg.doh_rate_limiter.interval = 0
+    nrg.doh_client = ReplayDohClient(revised)
+    stages = []
+    with FakeAppEngine():
+        with Stage('parse') as stage:
+            parsed = []
+            for response in fixture.values():
+                parsed.extend(nrg.iter_restaurants(StringIO(response),
+                                                   fields=nrg.DWR_FIELDS))
+            stage.items = len(parsed)
+        stages.append(stage)
+
+        with Stage('normalize') as stage:
+            records = [nrg.RestaurantRecord.from_dwr(fields)
+                       for fields in parsed]
+            stage.items = len(records)
+        del parsed
+        stages.append(stage)
+
+        with Stage('find') as stage:
+            nrg.snapshot_store.save(records)
+            for zipcode in fixture:
+                nrg.find_restaurants(zipcode=zipcode)
+            for record in records[:100]:
+                nrg.find_restaurants(name=record.name)
+            stage.items = len(fixture) + len(records[:100])
+        stages.append(stage)
+
+        with Stage('subscribe') as stage:
+            rng = random.Random(0)
+            restaurants = []
+            for record in records:
+                restaurant = nrg.Restaurant(
+                    key=nrg.Restaurant.make_key(record.camis))
+                for field in nrg.RestaurantRecord.FIELDS[1:]:
+                    setattr(restaurant, field, getattr(record, field))
+                restaurants.append(restaurant)
+            nrg.put_in_batches(restaurants)
+            for i in range(PIPELINE_USERS):
+                user_id = 'user%d' % i
+                user = nrg.User(key=nrg.User.make_key(user_id),
+                                email='%s@example.com' % user_id)
+                user.put()
+                chosen = rng.sample(restaurants, min(SUBSCRIPTIONS_PER_USER,
+                                                     len(restaurants)))
+                for restaurant in chosen:
+                    nrg.subscribe(nrg.Subscription(
+                        parent=user, key_name=restaurant.key().name(),
+                        restaurant=restaurant,
+                        notify_grade_change='email',
+                        notify_score_change='email',
+                        notify_inspection_change='email'))
+                    stage.items += 1
+        stages.append(stage)
+
+        with Stage('update') as stage:
+            counts = nrg.UpdateRestaurantPage().update_restaurants(
+                restaurants)
+            stage.items = sum(c['changed'] for c in counts.values())
+        stages.append(stage)
+
+        with Stage('notify') as stage:
+            stage.items = nrg.notify_all(nrg.LocalExecutor())
+        stages.append(stage)
+    return [timed.line() for timed in stages]
+
+def bench_pipeline(fixtures):
+    for label, fixture in fixtures:
+        print "== pipeline, %s: %d zipcodes" % (label, len(fixture))
+        for line in in_child(run_pipeline, fixture):
+            print line
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--restaurants', type='int', default=28000,
+                      help='number of restaurants in the citywide fixture')
+    parser.add_option('--fixtures', metavar='DIR',
+                      help='replay recorded responses from DIR')
+    parser.add_option('--record', metavar='DIR',
+                      help='record responses from the DoH site into DIR')
+    opts, _ = parser.parse_args()
+
+    if opts.record:
+        record_fixtures(opts.record, [SMALL_ZIPCODE, DENSE_ZIPCODE])
+        return
+
+    response = make_dwr_response(opts.restaurants)
+    print "citywide fixture: %d restaurants, %d bytes" % (
+        opts.restaurants, len(response))
+    bench_parse(response)
+    bench_records(response)
+    bench_reconcile([100, 1000, 3000])
+    bench_snapshot(response)
+    bench_memory(response)
+    bench_fetch(40, 0.25, [1, 4, 16])
+    bench_pipeline(pipeline_fixtures(opts.fixtures, opts.restaurants))
+
+if __name__ == "__main__":
+    main()
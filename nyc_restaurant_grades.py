@@ -4,33 +4,362 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import bisect
 import cgi
-from datetime import datetime, date
+import csv
+import functools
+import hashlib
+import httplib
+import itertools
+import cPickle as pickle
+from datetime import datetime, date, timedelta
 import jinja2
+import json
+import logging
 import os
+import Queue
+import random
 import re
+import socket
+import struct
+from StringIO import StringIO
+import threading
+import time
 import urllib
-import urllib2
+import urlparse
 import webapp2
-from collections import defaultdict
+import zlib
+from collections import defaultdict, deque, OrderedDict
+from operator import attrgetter
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from google.appengine.api import users as gusers
 from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+try:
+    import mmap
+except ImportError:
+    # Not available in the App Engine sandbox.
+    mmap = None
 
 jinja_environment = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)))
+    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+    bytecode_cache=jinja2.MemcachedBytecodeCache(memcache.Client()))
+
+# -------------------------------------------------------------------
+# Instrumentation
+#
+# Spans time named stretches of work, and counters count things like
+# datastore RPCs, bytes downloaded and records parsed.  Each request
+# collects its own, logs them as one JSON line when it finishes, and
+# adds them to the instance totals shown on /stats.  Unless
+# STATS_ENABLED is set, span() and count() do nothing.
+#
+
+STATS_ENABLED = os.environ.get('STATS_ENABLED') == 'true'
+# Number of recent requests shown on /stats.
+STATS_RECENT = 50
+
+class RequestStats(object):
+    """
+    The spans and counters collected for one request, possibly from
+    several threads.
+    """
+    def __init__(self, path):
+        self.path     = path
+        self.started  = time.time()
+        self.seconds  = None
+        self.lock     = threading.Lock()
+        self.spans    = defaultdict(lambda: [0, 0.0])
+        self.counters = defaultdict(int)
+
+    def add_span(self, name, seconds, count=1):
+        with self.lock:
+            span = self.spans[name]
+            span[0] += count
+            span[1] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def merge(self, other):
+        for name, (count, seconds) in other.spans.items():
+            self.add_span(name, seconds, count)
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def report(self):
+        return {'path': self.path,
+                'seconds': self.seconds,
+                'spans': dict((name, {'count': count, 'seconds': seconds})
+                              for name, (count, seconds) in self.spans.items()),
+                'counters': dict(self.counters)}
+
+class Span(object):
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name      = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.collector.add_span(self.name, time.time() - self.start)
+        return False
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Stats(object):
+    """
+    Hands out spans and counters for the request running on the
+    current thread.  Threads started for a request should bind() its
+    collector.
+    """
+    def __init__(self, enabled=STATS_ENABLED):
+        self.enabled  = enabled
+        self.local    = threading.local()
+        self.lock     = threading.Lock()
+        self.totals   = RequestStats('total')
+        self.requests = 0
+        self.recent   = deque(maxlen=STATS_RECENT)
+
+    def current(self):
+        return getattr(self.local, 'collector', None)
+
+    def bind(self, collector):
+        self.local.collector = collector
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        collector = self.current()
+        if collector is None:
+            return NULL_SPAN
+        return Span(collector, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        collector = self.current()
+        if collector is not None:
+            collector.count(name, n)
+
+    def timed(self, name):
+        """
+        Decorator that records each call to a function as a span.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def start(self, path):
+        collector = RequestStats(path)
+        self.bind(collector)
+        return collector
+
+    def finish(self, collector):
+        self.bind(None)
+        collector.seconds = time.time() - collector.started
+        report = collector.report()
+        logging.info('stats %s', json.dumps(report, sort_keys=True))
+        with self.lock:
+            self.totals.merge(collector)
+            self.requests += 1
+            self.recent.appendleft(report)
+
+stats = Stats()
+
+def count_rpc(service, call, request, response):
+    """
+    API proxy hook counting every RPC the app makes.
+    """
+    stats.count('rpc.%s.%s' % (service, call))
+
+if stats.enabled:
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('stats', count_rpc)
+
+def stats_middleware(app):
+    """
+    Wrap a WSGI app to collect stats for each request.
+    """
+    if not stats.enabled:
+        return app
+    def wrapped(environ, start_response):
+        collector = stats.start(environ.get('PATH_INFO'))
+        try:
+            return app(environ, start_response)
+        finally:
+            stats.finish(collector)
+    return wrapped
+
+class CountingStream(object):
+    """
+    Counts the bytes read from a file-like object under name.
+    """
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name   = name
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        stats.count(self.name, len(data))
+        return data
+
+# -------------------------------------------------------------------
+# Shared string tables
+#
+# Across the ~28k restaurants in the city there are only a few hundred
+# cuisines, a few thousand streets, a handful of grades and five
+# boroughs.  Rather than hold a string of its own for each, a
+# RestaurantRecord holds a code from one Codebook per field, shared by
+# every record, index and snapshot in the instance.  Zipcodes are
+# interned the same way.
+#
+
+class Codebook(object):
+    """
+    Numbers distinct values as they are first seen.  Codes are never
+    reused, so they stay valid for the life of the instance, and each
+    code is one shared int object, so holding one costs a pointer.
+    """
+    def __init__(self):
+        self.codes  = {}
+        self.values = []
+        self.lock   = threading.Lock()
+        self.ranked = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            with self.lock:
+                code = self.codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+    def intern(self, value):
+        """
+        The shared copy of value.
+        """
+        return self.values[self.code(value)]
+
+    def ranks(self):
+        """
+        A list giving where each code's value comes in sorted order,
+        so that codes can be sorted without comparing strings.
+        """
+        ranks = self.ranked
+        if ranks is None or len(ranks) != len(self.values):
+            values = self.values[:]
+            ranks = [0] * len(values)
+            order = sorted(range(len(values)), key=values.__getitem__)
+            for rank, code in enumerate(order):
+                ranks[code] = rank
+            self.ranked = ranks
+        return ranks
+
+STREETS  = Codebook()
+CUISINES = Codebook()
+GRADES   = Codebook()
+BOROUGHS = Codebook()
+ZIPCODES = Codebook()
+
+# The fields of RestaurantRecord stored as codes, and their tables.
+CODED_FIELDS = OrderedDict((('street', STREETS), ('cuisine', CUISINES),
+                            ('grade', GRADES), ('borough', BOROUGHS)))
+
+def coded_field(name, codebook):
+    """
+    A property that keeps a string as its code in codebook, in the
+    attribute name + '_code'.
+    """
+    attr = name + '_code'
+    def get(self):
+        return codebook.values[getattr(self, attr)]
+    def set(self, value):
+        setattr(self, attr, codebook.code(value))
+    return property(get, set)
 
 # -------------------------------------------------------------------
 # Reading DoH site
 #
 
-def parse_javascript(results):
+# Seconds to wait for a connection to the DoH site, and then for each
+# read from it, before giving up.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# How many times to retry a request that fails before any of the
+# response arrives, and how long to wait before the first retry.  The
+# wait roughly doubles after each retry.
+URL_RETRIES = 3
+URL_BACKOFF = 1.0
+# After this many requests in a row fail, stop sending requests for
+# BREAKER_COOLDOWN seconds.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+
+# Statements are read from the DoH response this many bytes at a time.
+CHUNK_SIZE = 64 * 1024
+
+# The DWR fields that fetch_restaurants actually uses.  Everything else
+# in the response is dropped while parsing.
+DWR_FIELDS = frozenset(('restCamis', 'restaurantName', 'restZipCode',
+                        'stName', 'cuisineType', 'restCurrentGrade',
+                        'scoreViolations', 'lastInspectedDate', 'brghCode'))
+
+# JavaScript statements of interest have form 's$NUM.$FIELD=$VAL'.
+STATEMENT_PATTERN = re.compile(r"^s(\d+)\.(\w+)=(.+)$")
+
+def iter_statements(stream, chunk_size=CHUNK_SIZE):
     """
-    Parse the JavaScript results containing restaurant grades.
-    Returns a list of dicts, one dict per restaurant.  We really
-    should use a real JavaScript parser here, but I couldn't get
-    spidermonkey to compile on my mac and this hacky thing will do.
+    Yield the semicolon-separated statements read from a file-like
+    object, one at a time.  The stream is consumed chunk_size bytes
+    at a time, and a statement that is split across two chunks is
+    held back until the rest of it arrives.
+    """
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        statements = (pending + chunk).split(";")
+        pending = statements.pop()
+        for statement in statements:
+            # The newlines are garbage - statements are
+            # semicolon-separated.
+            yield statement.replace("\r\n", "")
+    if pending:
+        yield pending.replace("\r\n", "")
+
+def iter_restaurants(stream, fields=None, chunk_size=CHUNK_SIZE):
+    """
+    Parse the JavaScript results containing restaurant grades,
+    yielding one dict per restaurant as soon as it is complete.  We
+    really should use a real JavaScript parser here, but I couldn't
+    get spidermonkey to compile on my mac and this hacky thing will
+    do.
 
     The JavaScript on this site looks like this:
 
@@ -39,41 +368,255 @@ def parse_javascript(results):
     s2.brghCode="1";s2.cuisineType="Ice Cream, Gelato, Yogurt, Ices";...
 
     It appears to be code to set a bunch of hashes called s0, s1, s2,
-    etc.
+    etc.  All the assignments to one hash are adjacent, so a hash is
+    complete once an assignment to the next one shows up.
+
+    If fields is given, only those fields are kept.
+    """
+    current_key = None
+    current = None
+    parsed = 0
+    for statement in iter_statements(stream, chunk_size):
+        # We're just looking for statements like "s$NUM.$FIELD=$VAL".
+        # We ignore all the other javascript for now...
+        m = STATEMENT_PATTERN.match(statement)
+        if not m:
+            continue
+        key, field, val = m.groups()
+        if key != current_key:
+            if current is not None:
+                parsed += 1
+                yield current
+            current_key = key
+            current = {}
+        if fields is None or field in fields:
+            current[field] = val.strip('"')  # remove quotes from values
+    if current is not None:
+        parsed += 1
+        yield current
+    stats.count('records_parsed', parsed)
+
+def parse_javascript(results):
+    """
+    Parse the JavaScript results containing restaurant grades.
+    Returns a list of dicts, one dict per restaurant.  See
+    iter_restaurants for the format.
+    """
+    return list(iter_restaurants(StringIO(results)))
 
-    So we parse this by translating it into a list of hashes, where
-    the s0 hash is the 0th element of the list, the s1 hash is the 1st
-    element, etc.
+class DohError(Exception):
+    """
+    The DoH site returned an error, or couldn't be reached.
     """
-    if not hasattr(parse_javascript, '_pattern'):
-        # JavaScript lines of interest have form 's$NUM.$FIELD=$VAL'.
-        parse_javascript._pattern = re.compile("^s(\d+)\.(\w+)=(.+)$")
 
-    # The newlines are garbage - statements are semicolon-separated.
-    lines = results.replace("\r\n", "").split(";")
+class CircuitOpenError(DohError):
+    """
+    Too many recent requests failed, so we aren't trying any more for
+    now.
+    """
 
-    restaurants = []
-    for line in lines:
-        # We're just looking for lines like "s$NUM.$FIELD=$VAL".
-        # We ignore all the other javascript for now...
-        m = parse_javascript._pattern.match(line)
-        if m:
-            key, field, val = m.groups()
-            key = int(key)
-            if key >= len(restaurants):
-                restaurants.extend({}
-                                   for i in range(key - len(restaurants) + 1))
-            r = restaurants[key]
-            r[field] = val.strip('"')  # remove quotes from values
+class CircuitBreaker(object):
+    """
+    Counts consecutive failures.  After threshold of them the circuit
+    opens, and check() raises CircuitOpenError until cooldown seconds
+    have passed.  Then one request is let through to see if things
+    are better.
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold  = threshold
+        self.cooldown   = cooldown
+        self.failures   = 0
+        self.opened     = None
+        self.lock       = threading.Lock()
 
-    return restaurants
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.time() - self.opened < self.cooldown:
+                raise CircuitOpenError('%d requests in a row failed' %
+                                       self.failures)
+            # Let one request through; fail again and we reopen.
+            self.opened = time.time()
 
-def read_url(url, params, tohash=False):
-    data = urllib2.urlopen(url, urllib.urlencode(params), 15000).read()
-    if tohash:
-        return parse_javascript(data)
-    else:
-        return data
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened   = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+class GzipStream(object):
+    """
+    Decompresses a gzip-encoded file-like object as it is read.  A
+    read may return more or less than size bytes, but only returns ''
+    at the end.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        while True:
+            chunk = self.stream.read(size)
+            if not chunk:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(chunk)
+            if data:
+                return data
+
+class DohClient(object):
+    """
+    HTTP client for the DoH site.  Each thread keeps its connection
+    open between requests.  Responses are requested gzipped.
+    Requests that fail, before the response arrives or while it is
+    being read, are retried with jittered exponential backoff, and a
+    CircuitBreaker stops us from waiting on the site when it is down.
+    A kept-alive connection that the site has closed is replaced at
+    once, without counting as a failure.
+
+    On App Engine, httplib only keeps connections alive when it uses
+    sockets rather than URL Fetch (GAE_USE_SOCKETS_HTTPLIB, set in
+    app.yaml).  Under URL Fetch there is no socket, and read_timeout
+    is the deadline for the whole request.
+    """
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=URL_RETRIES,
+                 backoff=URL_BACKOFF, breaker=None, sleep=time.sleep):
+        self.connect_timeout = connect_timeout
+        self.read_timeout    = read_timeout
+        self.retries         = retries
+        self.backoff         = backoff
+        self.breaker         = breaker or CircuitBreaker()
+        self.sleep           = sleep
+        self.local           = threading.local()
+
+    def connection(self, scheme, host):
+        """
+        This thread's open connection to host, if it can be reused,
+        or a new one.  Returns the connection and whether it was
+        reused.
+        """
+        connections = self.local.__dict__.setdefault('connections', {})
+        conn, response = connections.get((scheme, host), (None, None))
+        if conn is not None and response is not None and not response.isclosed():
+            # The last response wasn't read to the end, so the
+            # connection can't be reused.
+            conn.close()
+            conn = None
+        reused = conn is not None
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(host,
+                                               timeout=self.connect_timeout)
+            else:
+                conn = httplib.HTTPConnection(host,
+                                              timeout=self.connect_timeout)
+            conn.connect()
+            if conn.sock is not None:
+                conn.sock.settimeout(self.read_timeout)
+            else:
+                conn.timeout = self.read_timeout
+        connections[(scheme, host)] = (conn, None)
+        return conn, reused
+
+    def discard(self, scheme, host):
+        connections = self.local.__dict__.get('connections', {})
+        conn, response = connections.pop((scheme, host), (None, None))
+        if conn is not None:
+            conn.close()
+
+    def request(self, url, data):
+        """
+        POST data to url once.  Returns the response as a file-like
+        object, decompressed as it is read.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        while True:
+            conn, reused = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('POST', path, data, {
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Accept-Encoding': 'gzip',
+                    })
+                response = conn.getresponse()
+            except socket.timeout:
+                self.discard(parts.scheme, parts.netloc)
+                raise
+            except (httplib.BadStatusLine, socket.error):
+                self.discard(parts.scheme, parts.netloc)
+                if not reused:
+                    raise
+                # The site closed the connection while it sat idle;
+                # try again on a new one.
+                continue
+            except Exception:
+                self.discard(parts.scheme, parts.netloc)
+                raise
+            break
+        self.local.connections[(parts.scheme, parts.netloc)] = (conn, response)
+        if response.status != 200:
+            response.read()
+            raise DohError('%s: HTTP %d %s' % (url, response.status,
+                                               response.reason))
+        if response.getheader('Content-Encoding') == 'gzip':
+            return GzipStream(response)
+        return response
+
+    def post(self, url, params, read=lambda response: response):
+        """
+        POST params to url, with retries.  read is called with the
+        response as a file-like object, and what it returns is
+        returned; a request whose response fails part way through
+        being read is retried as a whole.
+        """
+        data = urllib.urlencode(params)
+        for attempt in range(self.retries + 1):
+            self.breaker.check()
+            try:
+                result = read(self.request(url, data))
+            except (DohError, httplib.HTTPException, socket.error,
+                    zlib.error) as e:
+                self.breaker.failed()
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logging.warning('%s: attempt %d failed, retrying in %.1fs: %s',
+                                url, attempt + 1, delay, e)
+                self.sleep(delay)
+            else:
+                self.breaker.succeeded()
+                return result
+
+doh_client = DohClient()
+
+def read_url(url, params, tohash=False, fields=None, build=None):
+    """
+    POST params to url.  If tohash is set, returns a list of the
+    restaurants in the response, parsed as the response streams in
+    and each passed through build if it is given; otherwise returns
+    the raw response.
+    """
+    def read(response):
+        stats.count('doh.requests')
+        if stats.enabled:
+            response = CountingStream(response, 'doh.bytes')
+        if not tohash:
+            return response.read()
+        # The body is parsed as it streams in, so this includes the
+        # time spent reading it.
+        with stats.span('parse'):
+            restaurants = iter_restaurants(response, fields=fields)
+            if build is not None:
+                return [build(restaurant) for restaurant in restaurants]
+            return list(restaurants)
+    with stats.span('doh.request'):
+        return doh_client.post(url, params, read)
 
 def rss_url(method):
     return ("http://a816-restaurantinspection.nyc.gov/"
@@ -91,12 +634,77 @@ def default_params(method, page):
             'batchId'         : '0'
             }
 
-def find_restaurants(name=None, zipcode=None):
+class RestaurantRecord(object):
     """
-    Download the restaurant grades for a given zipcode.
-    Returns as a list of dicts, one dict per restaurant.
+    One restaurant as returned by fetch_restaurants.  Only the
+    normalized fields are kept, so a citywide result set stays small:
+    the CODED_FIELDS are held as codes, and read and set as strings.
+    borough is the DoH borough code, '1' to '5', or '' if unknown; it
+    isn't stored with restaurants, so it is not one of FIELDS.
     """
+    FIELDS = ('camis', 'name', 'zipcode', 'street', 'cuisine',
+              'grade', 'score', 'last_inspected')
+    __slots__ = ('camis', 'name', 'zipcode', 'street_code', 'cuisine_code',
+                 'grade_code', 'borough_code', 'score', 'last_inspected')
+
+    street  = coded_field('street', STREETS)
+    cuisine = coded_field('cuisine', CUISINES)
+    grade   = coded_field('grade', GRADES)
+    borough = coded_field('borough', BOROUGHS)
+
+    def __init__(self, camis, name, zipcode, street, cuisine,
+                 grade, score, last_inspected, borough=''):
+        self.camis   = camis
+        self.name    = name
+        self.zipcode = ZIPCODES.intern(zipcode)
+        self.street  = street
+        self.cuisine = cuisine
+        self.grade   = grade
+        self.borough = borough
+        self.score   = score
+        self.last_inspected = last_inspected
+
+    @classmethod
+    def from_codes(cls, camis, name, zipcode, codes, score, last_inspected):
+        """
+        Build a record whose CODED_FIELDS are already codes, given as
+        a dict by field.
+        """
+        record = cls.__new__(cls)
+        record.camis   = camis
+        record.name    = name
+        record.zipcode = ZIPCODES.intern(zipcode)
+        for field in CODED_FIELDS:
+            setattr(record, field + '_code', codes[field])
+        record.score   = score
+        record.last_inspected = last_inspected
+        return record
+
+    @classmethod
+    def from_dwr(cls, fields):
+        """
+        Build a record from the raw DWR fields of one restaurant.
+        """
+        (month, day, year) = fields['lastInspectedDate'].split('/')
+        return cls(camis=fields['restCamis'],
+                   name=fields['restaurantName'],
+                   zipcode=int(fields['restZipCode']),
+                   street=fields['stName'],
+                   cuisine=fields['cuisineType'],
+                   grade=fields['restCurrentGrade'],
+                   score=int(fields['scoreViolations']),
+                   last_inspected=date(int(year), int(month), int(day)),
+                   borough=fields.get('brghCode', ''))
 
+    def __repr__(self):
+        return 'RestaurantRecord(%s)' % ', '.join(
+            '%s=%r' % (f, getattr(self, f)) for f in self.FIELDS)
+
+def search_params(name=None, zipcode=None, first=1, last=100000):
+    """
+    The URL and parameters for a search of the DoH site.  See
+    fetch_restaurants.
+    """
     method = 'getResultsSrchCriteria'
     url = rss_url(method)
     params = default_params(method, 'SearchResults')
@@ -109,189 +717,3033 @@ def find_restaurants(name=None, zipcode=None):
     params["c0-param0"] = "string:" + "\n".join(param0)
     params['c0-param1'] = 'string:'
     params['c0-param2'] = 'boolean:true'
-    params['c0-param3'] = 'number:1'        # result set lowest number
-    params['c0-param4'] = 'number:100000'   # result set highest number
-                                            #   [20 in the official website]
-                                            # There are about 28k restaurants total
-    restaurants = read_url(url, params, tohash=True)
-    for rest_hash in restaurants:
-        rest_hash['camis']   = rest_hash['restCamis']
-        rest_hash['name']    = rest_hash['restaurantName']
-        rest_hash['zipcode'] = int(rest_hash['restZipCode'])
-        rest_hash['street']  = rest_hash['stName']
-        rest_hash['cuisine'] = rest_hash['cuisineType']
-        rest_hash['grade']   = rest_hash['restCurrentGrade']
-        rest_hash['score']   = int(rest_hash['scoreViolations']) 
-        (month, day, year) = rest_hash['lastInspectedDate'].split('/')
-        rest_hash['last_inspected'] = date(int(year), int(month), int(day))
-    return restaurants
+    params['c0-param3'] = 'number:%d' % first   # result set lowest number
+    params['c0-param4'] = 'number:%d' % last    # result set highest number
+                                                #   [20 in the official website]
+                                                # There are about 28k restaurants total
+    return url, params
+
+@stats.timed('doh.fetch')
+def fetch_restaurants(name=None, zipcode=None, first=1, last=100000):
+    """
+    Download the restaurant grades for a given name and/or zipcode
+    from the DoH site.  With neither, downloads every restaurant in
+    the city.  first and last pick a range of the results, counting
+    from 1.  Returns a list of RestaurantRecords.
+    """
+    url, params = search_params(name, zipcode, first, last)
+    return read_url(url, params, tohash=True, fields=DWR_FIELDS,
+                    build=RestaurantRecord.from_dwr)
+
+@stats.timed('doh.fetch')
+def fetch_zipcode_if_changed(zipcode, digest=None):
+    """
+    Download the restaurants in zipcode, unless the response has the
+    given digest, in which case it isn't parsed.  Returns the digest
+    of the response, and a list of RestaurantRecords or None.
+    """
+    url, params = search_params(zipcode=zipcode)
+    data = read_url(url, params)
+    new_digest = hashlib.sha1(data).hexdigest()
+    if new_digest == digest:
+        return new_digest, None
+    with stats.span('parse'):
+        return new_digest, [RestaurantRecord.from_dwr(fields)
+                            for fields in iter_restaurants(StringIO(data),
+                                                           fields=DWR_FIELDS)]
+
+# -------------------------------------------------------------------
+# Reading the open data export
+#
+# The city also publishes every inspection as one big CSV file, with a
+# row per violation cited.  iter_bulk_restaurants collapses those rows
+# into one RestaurantRecord per restaurant as the file streams past, so
+# memory grows with the number of restaurants rather than the size of
+# the file.
+#
+
+BULK_EXPORT_URL = ('https://data.cityofnewyork.us/api/views/43nn-pn8j/'
+                   'rows.csv?accessType=DOWNLOAD')
+# The columns of the export that we use.
+BULK_COLUMNS = ('CAMIS', 'DBA', 'BORO', 'ZIPCODE', 'STREET',
+                'CUISINE DESCRIPTION', 'INSPECTION DATE', 'SCORE', 'GRADE',
+                'GRADE DATE')
+# Copies of the export downloaded in advance may be read from this
+# directory, by file name.
+BULK_EXPORT_DIR = os.environ.get('BULK_EXPORT_DIR')
+# The export names boroughs; the DoH site numbers them.
+BULK_BOROUGHS = {'MANHATTAN': '1', 'BRONX': '2', 'BROOKLYN': '3',
+                 'QUEENS': '4', 'STATEN ISLAND': '5'}
+
+def iter_lines(stream, chunk_size=CHUNK_SIZE):
+    """
+    Yield the lines read from a file-like object, chunk_size bytes at
+    a time.  Like iter_statements, but for newlines.
+    """
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def parse_bulk_date(value):
+    """
+    Parse a MM/DD/YYYY date from the export.  Returns None for blanks,
+    and for the 01/01/1900 the export gives restaurants that haven't
+    been inspected yet.
+    """
+    if not value:
+        return None
+    (month, day, year) = value.split()[0].split('/')
+    if int(year) <= 1900:
+        return None
+    return date(int(year), int(month), int(day))
+
+def iter_bulk_rows(stream, chunk_size=CHUNK_SIZE):
+    """
+    Yield a dict of the BULK_COLUMNS of each row of the export, as
+    unicode.  The export is UTF-8.
+    """
+    reader = csv.reader(iter_lines(stream, chunk_size))
+    header = [name.decode('utf-8-sig').strip().upper()
+              for name in next(reader)]
+    columns = [(name, header.index(name)) for name in BULK_COLUMNS]
+    for row in reader:
+        if len(row) < len(header):
+            continue
+        yield dict((name, row[i].decode('utf-8', 'replace'))
+                   for name, i in columns)
+
+def iter_bulk_restaurants(stream, camis=None, chunk_size=CHUNK_SIZE):
+    """
+    Read the open data export from a file-like object, and yield a
+    RestaurantRecord for each restaurant with its latest scored
+    inspection and latest grade.  If camis is given, only those
+    restaurants are kept.  A restaurant's rows can be anywhere in the
+    file, so nothing is yielded until all of it has been read.
+    """
+    latest = {}
+    grade_dates = {}
+    rows = 0
+    for row in iter_bulk_rows(stream, chunk_size):
+        rows += 1
+        key = row['CAMIS'].strip()
+        if camis is not None and key not in camis:
+            continue
+        zipcode = row['ZIPCODE'].strip()
+        inspected = parse_bulk_date(row['INSPECTION DATE'])
+        if not zipcode.isdigit() or inspected is None:
+            continue
+        record = latest.get(key)
+        if record is None:
+            record = latest[key] = RestaurantRecord(
+                camis=key, name=row['DBA'], zipcode=int(zipcode),
+                street=row['STREET'], cuisine=row['CUISINE DESCRIPTION'],
+                grade='', score=None, last_inspected=date.min,
+                borough=BULK_BOROUGHS.get(row['BORO'].strip().upper(), ''))
+            grade_dates[key] = date.min
+        score = row['SCORE'].strip()
+        if score and inspected > record.last_inspected:
+            record.name    = row['DBA']
+            record.zipcode = int(zipcode)
+            record.street  = row['STREET']
+            record.cuisine = row['CUISINE DESCRIPTION']
+            record.score   = int(score)
+            record.last_inspected = inspected
+        graded = parse_bulk_date(row['GRADE DATE'])
+        if row['GRADE'] and graded is not None and graded >= grade_dates[key]:
+            record.grade = row['GRADE']
+            grade_dates[key] = graded
+    stats.count('bulk.rows', rows)
+    for record in latest.itervalues():
+        if record.score is not None:
+            yield record
+
+def bulk_export_path(source=None):
+    """
+    Where to read the export from.  source is None to download it from
+    BULK_EXPORT_URL, for which None is returned, or the name of a copy
+    downloaded in advance into BULK_EXPORT_DIR, whose path is
+    returned.  Nothing else can be read, so that a request can't be
+    used to read other files or fetch other URLs.  Raises ValueError
+    for any other source.
+    """
+    if not source or source == BULK_EXPORT_URL:
+        return None
+    if not BULK_EXPORT_DIR:
+        raise ValueError('no BULK_EXPORT_DIR to read %r from' % source)
+    directory = os.path.realpath(BULK_EXPORT_DIR)
+    path = os.path.realpath(os.path.join(directory, source))
+    if os.path.dirname(path) != directory:
+        raise ValueError('%r is not a file in BULK_EXPORT_DIR' % source)
+    return path
+
+def open_bulk_export(source=None):
+    """
+    Open the export from source (see bulk_export_path) for reading.
+    URL Fetch won't return a response as big as the export, so on App
+    Engine downloading only works when httplib uses sockets
+    (GAE_USE_SOCKETS_HTTPLIB).
+    """
+    path = bulk_export_path(source)
+    if path is None:
+        return urllib.urlopen(BULK_EXPORT_URL)
+    return open(path, 'rb')
+
+# -------------------------------------------------------------------
+# Data models
+#
+
+# Most entities to get, put or delete in one datastore call.
+DATASTORE_BATCH_SIZE = 500
+
+def batches(items, size):
+    """
+    Split a list into lists of at most size items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def get_in_batches(keys, batch_size=DATASTORE_BATCH_SIZE):
+    entities = []
+    for batch in batches(keys, batch_size):
+        entities.extend(db.get(batch))
+    return entities
+
+def put_in_batches(entities, batch_size=DATASTORE_BATCH_SIZE):
+    for batch in batches(entities, batch_size):
+        db.put(batch)
+
+def delete_in_batches(keys, batch_size=DATASTORE_BATCH_SIZE):
+    for batch in batches(keys, batch_size):
+        db.delete(batch)
+
+def memoize_method(method):
+    """
+    Cache the result of a method that takes no arguments on the
+    instance it is called on.
+    """
+    attr = '_memo_' + method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        if attr not in self.__dict__:
+            self.__dict__[attr] = method(self)
+        return self.__dict__[attr]
+    return wrapper
+
+class Restaurant(db.Model):
+    """
+    Models a subscription to a particular restaurant.
+    """
+    name     = db.StringProperty()
+    zipcode  = db.IntegerProperty()
+    street   = db.StringProperty()
+    cuisine  = db.StringProperty()
+    grade    = db.StringProperty()
+    score    = db.IntegerProperty()
+    last_inspected = db.DateProperty()
+    prev_grade     = db.StringProperty()
+    prev_score     = db.IntegerProperty()
+    prev_inspected = db.DateProperty()
+    last_updated   = db.DateTimeProperty()
+
+    @classmethod
+    def make_key(cls, camis):
+        """
+        Constructs a Datastore key for a restaurant.
+        """
+        return db.Key.from_path('Restaurant', camis)
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        A new, unsaved restaurant from a RestaurantRecord.
+        """
+        return cls(key_name=record.camis
+                   ,name=record.name
+                   ,zipcode=record.zipcode
+                   ,street=record.street
+                   ,cuisine=record.cuisine
+                   ,grade=record.grade
+                   ,score=record.score
+                   ,last_inspected=record.last_inspected
+                   ,prev_grade=record.grade
+                   ,prev_score=record.score
+                   ,prev_inspected=record.last_inspected
+                   ,last_updated=datetime.now()
+                   )
+
+    def record(self):
+        """
+        The restaurant as a RestaurantRecord.
+        """
+        return RestaurantRecord(self.key().name(), self.name, self.zipcode,
+                                self.street, self.cuisine, self.grade,
+                                self.score, self.last_inspected)
+
+class User(db.Model):
+    last_notified = db.DateTimeProperty()
+    email = db.StringProperty()
+    # Sequence number of the last ChangeEvent this user was notified of.
+    event_cursor = db.IntegerProperty(default=0)
+
+    @classmethod
+    def make_key(cls, user_id):
+        """
+        Construct a User key from a user id
+        """
+        return db.Key.from_path('User', user_id)
+
+class Subscription(db.Model):
+    NOTIFY_CHOICES=["email", "sms", "none"]
+    restaurant = db.ReferenceProperty(Restaurant,
+                                      required=True)
+    notify_grade_change = db.StringProperty(
+        required=True,
+        choices=set(NOTIFY_CHOICES))
+    notify_score_change = db.StringProperty(
+        required=True,
+        choices=set(NOTIFY_CHOICES))
+    notify_inspection_change = db.StringProperty(
+        required=True,
+        choices=set(NOTIFY_CHOICES))    
+
+    @classmethod
+    def make_key(cls, user_id, camis):
+        """
+        Construct a Subscription key from a user id and a restaurant
+        id
+        """
+        return db.Key.from_path('User', user_id, 'Subscription', camis)
+
+    @classmethod
+    def color(cls, value):
+        if value == 'none':
+            return 'red'
+        else:
+            return 'green'
+
+    @classmethod
+    def text(cls, value):
+        if value == 'none':
+            return 'OFF'
+        else:
+            return 'ON'
+
+    @property
+    def grade_change_color(self):
+        return self.color(self.notify_grade_change)
+
+    @property
+    def grade_change_button(self):
+        return self.text(self.notify_grade_change)
+
+    @property
+    def score_change_color(self):
+        return self.color(self.notify_score_change)
+
+    @property
+    def score_change_button(self):
+        return self.text(self.notify_score_change)
+
+    @property
+    def inspection_change_color(self):
+        return self.color(self.notify_inspection_change)
+
+    @property
+    def inspection_change_button(self):
+        return self.text(self.notify_inspection_change)
+
+    def attach(self, restaurant, user):
+        """
+        Attach already-fetched restaurant and parent user entities, so
+        that dereferencing them later doesn't go to the datastore.
+        """
+        self.restaurant = restaurant
+        # db.Model.parent() only fetches the parent if _parent is unset.
+        self._parent = user
+
+    def needs_change_text(self, value):
+        if value:
+            return 'YES'
+        else:
+            return 'no'
+
+    def needs_notify(self, field, prev_field, should_notify):
+        """
+        When a new restaurant is added, it is added with
+        current grade == prev grade, so that we don't send
+        notifications.
+
+        Once something about the restaurant changes, the current value
+        of the field will change, and the last_updated value will be
+        updated and be more recent than the user's last notified
+        field.
+        """
+        return ((self.parent().last_notified is None or
+                 self.parent().last_notified < self.restaurant.last_updated)
+                and should_notify != 'none'
+                and field != prev_field)
+
+    @memoize_method
+    def needs_grade_notify(self):
+        return self.needs_notify(self.restaurant.grade,
+                                 self.restaurant.prev_grade,
+                                 self.notify_grade_change)
+
+    def grade_notify_text(self):
+        return self.needs_change_text(self.needs_grade_notify())
+
+    @memoize_method
+    def needs_score_notify(self):
+        return self.needs_notify(self.restaurant.score,
+                                 self.restaurant.prev_score,
+                                 self.notify_score_change)
+
+    def score_notify_text(self):
+        return self.needs_change_text(self.needs_score_notify())
+
+    @memoize_method
+    def needs_inspection_notify(self):
+        return self.needs_notify(self.restaurant.last_inspected,
+                                 self.restaurant.prev_inspected,
+                                 self.notify_inspection_change)
+
+    def inspection_notify_text(self):
+        return self.needs_change_text(self.needs_inspection_notify())
+
+class ChangeEvent(db.Model):
+    """
+    One change to a restaurant seen by the nightly update.  Events are
+    numbered in the order they were recorded, and are children of the
+    EventSequence that numbers them, so that they are put in the same
+    transaction as their numbers are handed out.  Until then they may
+    be staged, unnumbered, under some other parent (see
+    stage_events).  They are keyed by
+    what changed and the inspection that changed it, so an update that
+    is run again after being cut short rewrites its events rather than
+    adding more, while the same change on a later inspection is kept
+    as an event of its own.
+    """
+    # Restaurant fields that generate events, and the Subscription
+    # setting that says whether to notify about each.
+    NOTIFY_SETTINGS = {'grade':          'notify_grade_change',
+                       'score':          'notify_score_change',
+                       'last_inspected': 'notify_inspection_change'}
+    camis     = db.StringProperty(required=True)
+    field     = db.StringProperty(required=True,
+                                  choices=set(NOTIFY_SETTINGS))
+    old       = db.StringProperty(indexed=False)
+    new       = db.StringProperty(indexed=False)
+    timestamp = db.DateTimeProperty(required=True)
+    sequence  = db.IntegerProperty()
+
+    @staticmethod
+    def key_name_for(camis, inspected, field, old, new):
+        return u'%s:%s:%s:%s:%s' % (camis, inspected, field, old, new)
+
+    def should_notify(self, subscription):
+        return getattr(subscription, self.NOTIFY_SETTINGS[self.field]) != 'none'
+
+    def copy_to(self, parent):
+        """
+        An unsaved copy of this event under parent, with the same key
+        name.
+        """
+        return ChangeEvent(parent=parent, key_name=self.key().name(),
+                           camis=self.camis, field=self.field, old=self.old,
+                           new=self.new, timestamp=self.timestamp,
+                           sequence=self.sequence)
+
+    def describe(self):
+        """
+        What happened, to follow the restaurant's name in an email.
+        """
+        if self.field == 'last_inspected':
+            return 'was inspected on %s' % self.new
+        return 'changed its %s from %s to %s on %s' % (
+            self.field, self.old, self.new, self.timestamp)
+
+def change_events(restaurant, update, timestamp):
+    """
+    The unsaved ChangeEvents for the fields that differ between a
+    stored restaurant and an update.
+    """
+    camis = restaurant.key().id_or_name()
+    events = []
+    for field in sorted(ChangeEvent.NOTIFY_SETTINGS):
+        old = unicode(getattr(restaurant, field))
+        new = unicode(getattr(update, field))
+        if old != new:
+            events.append(ChangeEvent(
+                parent=EventSequence.make_key(),
+                key_name=ChangeEvent.key_name_for(
+                    camis, update.last_inspected, field, old, new),
+                camis=camis, field=field, old=old, new=new,
+                timestamp=timestamp))
+    return events
+
+class EventSequence(db.Model):
+    """
+    Singleton holding the last ChangeEvent sequence number handed out.
+    It is the parent of every ChangeEvent.
+    """
+    KEY_NAME = 'events'
+    last = db.IntegerProperty(default=0)
+
+    @classmethod
+    def make_key(cls):
+        return db.Key.from_path('EventSequence', cls.KEY_NAME)
+
+def current_sequence():
+    sequence = EventSequence.get_by_key_name(EventSequence.KEY_NAME)
+    if sequence is None:
+        return 0
+    return sequence.last
+
+def put_events(events, batch_size=DATASTORE_BATCH_SIZE - 1):
+    """
+    Number events, in order, after every event numbered so far, and
+    put them in the transaction that hands out their numbers.  An
+    event is never seen before one numbered ahead of it, so a notify
+    run that has reached a number has seen every event up to it.
+    """
+    for batch in batches(events, batch_size):
+        db.run_in_transaction(number_events, batch)
+
+def number_events(events, staged=()):
+    """
+    Number and put events, and delete the staged events they were
+    copied from.  Must be run in a transaction.
+    """
+    sequence = (EventSequence.get_by_key_name(EventSequence.KEY_NAME)
+                or EventSequence(key_name=EventSequence.KEY_NAME))
+    for i, event in enumerate(events):
+        event.sequence = sequence.last + 1 + i
+    sequence.last += len(events)
+    db.put([sequence] + events)
+    if staged:
+        db.delete(staged)
+
+def stage_events(parent, events, batch_size=DATASTORE_BATCH_SIZE):
+    """
+    Put events under parent, unnumbered, for put_staged_events to
+    number later.  Writers running in parallel, such as the units of
+    an update job, stage their events so that they don't all contend
+    for the EventSequence's entity group.  Staged events are keyed
+    like numbered ones, so staging them again rewrites them.
+    """
+    put_in_batches([event.copy_to(parent) for event in events], batch_size)
+
+def put_staged_events(parent, batch_size=DATASTORE_BATCH_SIZE - 1):
+    """
+    Number the events staged under parent, moving them under the
+    EventSequence.  Each batch is moved in one transaction, so this
+    can be run again after being cut short.
+    """
+    while True:
+        staged = ChangeEvent.all().ancestor(parent).fetch(batch_size)
+        if not staged:
+            break
+        events = [event.copy_to(EventSequence.make_key()) for event in staged]
+        run_in_xg_transaction(number_events, events, staged)
+
+def events_after(sequence):
+    """
+    Every ChangeEvent numbered after sequence, in order.  This is an
+    ancestor query, so it sees every event put so far.
+    """
+    return (ChangeEvent.all().ancestor(EventSequence.make_key())
+            .filter('sequence >', sequence).order('sequence'))
+
+class SubscriberIndexState(db.Model):
+    """
+    Exists once RestaurantSubscribers has been built from every
+    subscription.  Subscriptions made before the index existed are
+    only in it after that.
+    """
+    KEY_NAME = 'state'
+    built = db.DateTimeProperty(required=True)
+
+class RestaurantSubscribers(db.Model):
+    """
+    Reverse index from a restaurant to the users subscribed to it.
+    Each restaurant's subscribers are spread over SHARDS entities, by
+    user, so that popular restaurants don't serialize subscribes.
+
+    Until the index has been built (see ready), readers fall back to
+    scanning the keys of every Subscription.
+    """
+    SHARDS = 4
+    # Set once this instance has seen SubscriberIndexState.
+    index_built = False
+    camis       = db.StringProperty(required=True)
+    subscribers = db.ListProperty(db.Key, indexed=False)
+    count       = db.IntegerProperty(default=0)
+
+    @classmethod
+    def make_key(cls, camis, shard):
+        return db.Key.from_path('RestaurantSubscribers',
+                                '%s:%d' % (camis, shard))
+
+    @classmethod
+    def shard_key(cls, camis, user_key):
+        """
+        The key of the shard that user_key belongs in for camis.
+        """
+        shard = zlib.crc32(str(user_key.id_or_name())) % cls.SHARDS
+        return cls.make_key(camis, shard)
+
+    @classmethod
+    def add(cls, camis, user_key):
+        """
+        Record that user_key subscribes to camis.  Call this in the
+        transaction that puts the subscription.
+        """
+        key = cls.shard_key(camis, user_key)
+        shard = db.get(key) or cls(key=key, camis=camis)
+        if user_key not in shard.subscribers:
+            shard.subscribers.append(user_key)
+            shard.count = len(shard.subscribers)
+            shard.put()
+
+    @classmethod
+    def add_all(cls, camis_list, user_key):
+        """
+        Record that user_key subscribes to each of camis_list, with
+        one batch get and put.  Call this in the transaction that puts
+        the subscriptions.
+        """
+        keys = [cls.shard_key(camis, user_key) for camis in camis_list]
+        changed = []
+        for camis, key, shard in zip(camis_list, keys, db.get(keys)):
+            shard = shard or cls(key=key, camis=camis)
+            if user_key not in shard.subscribers:
+                shard.subscribers.append(user_key)
+                shard.count = len(shard.subscribers)
+                changed.append(shard)
+        db.put(changed)
+
+    @classmethod
+    def remove(cls, camis, user_key):
+        """
+        Record that user_key no longer subscribes to camis.  Call this
+        in the transaction that deletes the subscription.
+        """
+        shard = db.get(cls.shard_key(camis, user_key))
+        if shard is not None and user_key in shard.subscribers:
+            shard.subscribers.remove(user_key)
+            shard.count = len(shard.subscribers)
+            shard.put()
+
+    @classmethod
+    def ready(cls):
+        """
+        Whether the index has been built.  If it hasn't, a rebuild is
+        queued.
+        """
+        if not cls.index_built:
+            cls.index_built = SubscriberIndexState.get_by_key_name(
+                SubscriberIndexState.KEY_NAME) is not None
+            if not cls.index_built:
+                queue_subscribers_rebuild()
+        return cls.index_built
+
+    @classmethod
+    def lookup(cls, camis_list, batch_size=DATASTORE_BATCH_SIZE):
+        """
+        The keys of users subscribed to any of the restaurants in
+        camis_list.
+        """
+        if not cls.ready():
+            camis_list = set(camis_list)
+            return set(key.parent()
+                       for key in Subscription.all(keys_only=True)
+                       if key.id_or_name() in camis_list)
+        keys = [cls.make_key(camis, shard)
+                for camis in camis_list for shard in range(cls.SHARDS)]
+        users = set()
+        for shard in get_in_batches(keys, batch_size):
+            if shard is not None:
+                users.update(shard.subscribers)
+        return users
+
+    @classmethod
+    def used(cls):
+        """
+        The camis of every restaurant with at least one subscriber.
+        """
+        if not cls.ready():
+            return set(key.id_or_name()
+                       for key in Subscription.all(keys_only=True))
+        return set(shard.camis for shard in cls.all().filter('count >', 0))
+
+    @classmethod
+    def rebuild(cls, batch_size=DATASTORE_BATCH_SIZE):
+        """
+        Add every subscription to the index, then mark it built.
+        Entries are only added, one shard per transaction, so
+        subscribes made while this runs are kept.
+        """
+        wanted = defaultdict(set)
+        for key in Subscription.all(keys_only=True):
+            camis = key.id_or_name()
+            wanted[cls.shard_key(camis, key.parent())].add(key.parent())
+        keys = wanted.keys()
+        for key, shard in zip(keys, get_in_batches(keys, batch_size)):
+            if shard is not None and wanted[key] <= set(shard.subscribers):
+                continue
+            def txn(key=key):
+                shard = db.get(key) or cls(key=key,
+                                           camis=key.name().rsplit(':', 1)[0])
+                missing = wanted[key] - set(shard.subscribers)
+                shard.subscribers.extend(missing)
+                shard.count = len(shard.subscribers)
+                shard.put()
+            db.run_in_transaction(txn)
+        SubscriberIndexState(key_name=SubscriberIndexState.KEY_NAME,
+                             built=datetime.now()).put()
+        cls.index_built = True
+
+def rebuild_subscribers():
+    RestaurantSubscribers.rebuild()
+
+def queue_subscribers_rebuild():
+    """
+    Ask for the subscriber index to be built in the background.  The
+    task is named, so only one is ever queued.
+    """
+    try:
+        deferred.defer(rebuild_subscribers, _name='rebuild-subscribers')
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+def run_in_xg_transaction(func, *args, **kwargs):
+    """
+    Run func in a transaction that may span entity groups, such as a
+    user's and a restaurant's subscriber index.
+    """
+    return db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), func, *args, **kwargs)
+
+def subscribe(subscription):
+    """
+    Put a new subscription and index it, in one transaction.
+    """
+    def txn():
+        subscription.put()
+        RestaurantSubscribers.add(subscription.key().id_or_name(),
+                                  subscription.parent_key())
+    run_in_xg_transaction(txn)
+
+# Subscriptions put per transaction by subscribe_all: with the user's
+# entity group and one subscriber shard each, that is the most entity
+# groups a transaction may use.
+SUBSCRIBE_BATCH_SIZE = 24
+
+def subscribe_all(user, subscriptions):
+    """
+    Put user and new subscriptions of theirs, and index them.  Each
+    transaction puts SUBSCRIBE_BATCH_SIZE subscriptions with one
+    batch put into the user's entity group.
+    """
+    for i, batch in enumerate(batches(subscriptions, SUBSCRIBE_BATCH_SIZE)):
+        def txn():
+            db.put(([user] if i == 0 else []) + batch)
+            RestaurantSubscribers.add_all(
+                [sub.key().id_or_name() for sub in batch], user.key())
+        run_in_xg_transaction(txn)
+
+def unsubscribe(subscription_key):
+    """
+    Delete a subscription and unindex it, in one transaction.
+    """
+    def txn():
+        db.delete(subscription_key)
+        RestaurantSubscribers.remove(subscription_key.id_or_name(),
+                                     subscription_key.parent())
+    run_in_xg_transaction(txn)
+
+def prune_restaurants(batch_size=DATASTORE_BATCH_SIZE):
+    """
+    Delete the restaurants nobody subscribes to.  Returns the camis
+    of the rest.
+    """
+    used = RestaurantSubscribers.used()
+    delete_in_batches([k for k in Restaurant.all(keys_only=True)
+                       if k.id_or_name() not in used],
+                      batch_size)
+    return used
+
+def prefetch_subscriptions(subscriptions, user=None):
+    """
+    Fetch the restaurants and parent users of subscriptions with one
+    batch get, and attach them, so that rendering them takes no more
+    datastore calls.  Pass user if it is already known to be the
+    parent of all of them.  Subscriptions whose restaurant no longer
+    exists are dropped.
+    """
+    subscriptions = list(subscriptions)
+    keys = [Subscription.restaurant.get_value_for_datastore(s)
+            for s in subscriptions]
+    parent_keys = []
+    if user is None:
+        parent_keys = list(set(s.parent_key() for s in subscriptions))
+    entities = db.get(keys + parent_keys)
+    parents = dict(zip(parent_keys, entities[len(keys):]))
+    prefetched = []
+    for sub, restaurant in zip(subscriptions, entities[:len(keys)]):
+        if restaurant is None:
+            continue
+        sub.attach(restaurant, user or parents[sub.parent_key()])
+        prefetched.append(sub)
+    return prefetched
+
+# -------------------------------------------------------------------
+# Restaurant snapshot
+#
+# Searches are answered from a local copy of every restaurant in the
+# city rather than by asking the DoH site each time.  The snapshot is
+# pulled once a day by cron (or on demand), serialized into a backend,
+# and kept in instance memory.  Once it is older than SNAPSHOT_TTL it
+# is still served, but a refresh is queued in the background.
+#
+# The serialized form is a binary file laid out so that it can be
+# searched where it lies, without unpacking it into objects first:
+#
+#  - an 8 byte magic number and a JSON header giving the offset and
+#    length of each section,
+#  - 'records': fixed-width rows of SNAPSHOT_RECORD, with names
+#    stored as numbers in the string table, and the CODED_FIELDS as
+#    positions in a 'table:<field>' section,
+#  - the string table: 'string_offsets' into 'string_data',
+#  - 'table:<field>' for each of CODED_FIELDS: the string numbers of
+#    its distinct values, which are mapped to the instance's codes
+#    once, as the snapshot is loaded,
+#  - 'camis' and 'camis_positions': the camis of every row, sorted,
+#    and the row each belongs to,
+#  - 'zipcodes', 'zipcode_starts' and 'zipcode_positions': the rows
+#    for zipcodes[i] are zipcode_positions[zipcode_starts[i]:
+#    zipcode_starts[i + 1]],
+#  - 'words', 'word_starts' and 'word_positions': the same for the
+#    words in names, with the words as string numbers in sorted order,
+#  - 'order:<key>' and 'rank:<key>' for each of RestaurantIndex's
+#    SORT_KEYS.
+#
+# Sections are read with numpy.frombuffer, so loading a snapshot only
+# parses the header, and a memory-mapped file is never read in full.
+#
+
+SNAPSHOT_KEY = 'restaurants:v3'
+SNAPSHOT_MAGIC = 'NYCRGSS3'
+# numpy is imported where it is used, so that handlers which never
+# touch the snapshot don't pay for importing it, and these dtypes are
+# given in the form numpy.dtype() takes.
+SNAPSHOT_RECORD = [('camis', '<i8'), ('name', '<i4'),
+                   ('zipcode', '<i4'), ('street', '<i4'),
+                   ('cuisine', '<i2'), ('grade', '<i2'),
+                   ('borough', '<i2'), ('score', '<i4'),
+                   ('last_inspected', '<i4')]
+# The dtype of each section; the rest are '<i4'.
+SNAPSHOT_DTYPES = {'records': SNAPSHOT_RECORD, 'camis': '<i8',
+                   'string_data': 'S1'}
+NON_WORD_PATTERN = re.compile(r"[^A-Z0-9]+")
+ZIPCODE_PATTERN = re.compile(r"^[0-9]+$")
+SNAPSHOT_TTL = timedelta(hours=24)
+# How often an instance holding a stale snapshot looks for a new one.
+SNAPSHOT_RECHECK = timedelta(minutes=5)
+
+class SnapshotChunk(db.Model):
+    """
+    One piece of a serialized snapshot.  The entity with key_name
+    <key> is the header: it names the current version and how many
+    <key>:<version>:<n> chunks it has, and the same for the version
+    before, which is kept for readers that are still reading it.
+    Headers written before versions had <key>:<n> chunks.
+    """
+    data   = db.BlobProperty()
+    chunks = db.IntegerProperty()
+    version  = db.StringProperty(indexed=False)
+    previous = db.StringProperty(indexed=False)
+    previous_chunks = db.IntegerProperty(indexed=False)
+
+    @staticmethod
+    def chunk_names(key, version, chunks):
+        if version is None:
+            return ['%s:%d' % (key, i) for i in range(chunks)]
+        return ['%s:%s:%d' % (key, version, i) for i in range(chunks)]
+
+class DatastoreBackend(object):
+    """
+    Stores blobs in the datastore, split to fit under the entity size
+    limit.  Each blob is written as a new version of its chunks, and
+    only then made current by rewriting the header, so a reader never
+    sees a mix of two blobs.
+    """
+    CHUNK_SIZE = 900 * 1024
+
+    def get(self, key):
+        header = SnapshotChunk.get_by_key_name(key)
+        if header is None:
+            return None
+        chunks = SnapshotChunk.get_by_key_name(SnapshotChunk.chunk_names(
+            key, header.version, header.chunks))
+        if None in chunks:
+            return None
+        return ''.join(c.data for c in chunks)
+
+    def set(self, key, value):
+        version = '%016x' % random.getrandbits(64)
+        pieces = range(0, len(value), self.CHUNK_SIZE)
+        db.put([SnapshotChunk(key_name=name,
+                              data=db.Blob(value[pos:pos + self.CHUNK_SIZE]))
+                for name, pos in zip(SnapshotChunk.chunk_names(
+                    key, version, len(pieces)), pieces)])
+        def txn():
+            header = SnapshotChunk.get_by_key_name(key)
+            SnapshotChunk(key_name=key, version=version, chunks=len(pieces),
+                          previous=header and header.version,
+                          previous_chunks=header and header.chunks).put()
+            if header is None or header.previous_chunks is None:
+                return []
+            return SnapshotChunk.chunk_names(key, header.previous,
+                                             header.previous_chunks)
+        stale = db.run_in_transaction(txn)
+        db.delete([db.Key.from_path('SnapshotChunk', name)
+                   for name in stale])
+
+class MemcacheBackend(object):
+    """
+    Stores blobs in memcache, split to fit under the value size
+    limit.  Cheaper than the datastore, but may be evicted.
+    """
+    CHUNK_SIZE = 900 * 1024
+
+    def get(self, key):
+        count = memcache.get(key)
+        if count is None:
+            return None
+        names = ['%s:%d' % (key, i) for i in range(count)]
+        chunks = memcache.get_multi(names)
+        if len(chunks) != count:
+            return None
+        return ''.join(chunks[n] for n in names)
+
+    def set(self, key, value):
+        chunks = dict(('%s:%d' % (key, i), value[pos:pos + self.CHUNK_SIZE])
+                      for i, pos in enumerate(range(0, len(value),
+                                                    self.CHUNK_SIZE)))
+        memcache.set_multi(chunks)
+        memcache.set(key, len(chunks))
+
+class MemoryBackend(object):
+    """
+    Keeps blobs in a dict.  For tests and the dev server.
+    """
+    def __init__(self):
+        self.blobs = {}
+
+    def get(self, key):
+        return self.blobs.get(key)
+
+    def set(self, key, value):
+        self.blobs[key] = value
+
+class FileBackend(object):
+    """
+    Stores blobs as files in directory.  Where mmap is available, get()
+    maps the file read-only rather than reading it.  App Engine can't
+    write files, so this is for the dev server and for snapshots
+    deployed with the app.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key.replace(':', '.'))
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            if mmap is None:
+                return f.read()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def set(self, key, value):
+        # Write a new file rather than over one that may be mapped.
+        path = self.path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(value)
+        os.rename(path + '.tmp', path)
+
+def name_tokens(name):
+    """
+    Split a restaurant name into upper-case words, ignoring
+    punctuation, so "Joe's Pizza" gives ['JOE', 'S', 'PIZZA'].
+    """
+    return NON_WORD_PATTERN.sub(' ', name.upper()).split()
+
+def parse_zipcode(value):
+    """
+    A zipcode from a search, as an int, or None if it isn't one.
+    """
+    if isinstance(value, (int, long)):
+        return value
+    value = value.strip()
+    if not ZIPCODE_PATTERN.match(value):
+        return None
+    return int(value)
+
+class RestaurantIndex(object):
+    """
+    In-memory indexes over a list of restaurants:
+
+     - by camis,
+     - by zipcode,
+     - by the words in their names, with a sorted word list so that
+       words can be looked up by prefix,
+     - presorted orders for each of SORT_KEYS, so that an unfiltered
+       sorted page is just a slice.
+
+    Restaurants are referred to by their position in the list.
+    """
+    SORT_KEYS = ('name', 'score', 'grade', 'last_inspected',
+                 'zipcode', 'street', 'cuisine')
+
+    def __init__(self, restaurants):
+        self.restaurants = restaurants
+        self.by_camis = {}
+        self.by_zipcode = defaultdict(list)
+        self.by_word = defaultdict(list)
+        for pos, r in enumerate(restaurants):
+            self.by_camis[r.camis] = pos
+            self.by_zipcode[r.zipcode].append(pos)
+            for word in set(name_tokens(r.name)):
+                self.by_word[word].append(pos)
+        self.words = sorted(self.by_word)
+
+        # order[key] lists positions sorted by key; rank[key][pos] is
+        # where pos comes in that order.
+        self.order = {}
+        self.rank = {}
+        for key in self.SORT_KEYS:
+            if key in CODED_FIELDS:
+                # Sort by where each code's string comes, rather than
+                # comparing the strings themselves.
+                ranks = CODED_FIELDS[key].ranks()
+                code = attrgetter(key + '_code')
+                getter = lambda r: (ranks[code(r)], r.name)
+            else:
+                getter = attrgetter(key, 'name')
+            order = sorted(range(len(restaurants)),
+                           key=lambda pos: getter(restaurants[pos]))
+            rank = [0] * len(restaurants)
+            for i, pos in enumerate(order):
+                rank[pos] = i
+            self.order[key] = order
+            self.rank[key] = rank
+
+    def get(self, camis):
+        """
+        The restaurant with the given camis, or None.
+        """
+        pos = self.by_camis.get(camis)
+        if pos is None:
+            return None
+        return self.restaurants[pos]
+
+    def match_prefix(self, prefix):
+        """
+        The positions of restaurants with a word in their name
+        starting with prefix.
+        """
+        matches = set()
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            matches.update(self.by_word[self.words[i]])
+            i += 1
+        return matches
+
+    def search(self, name=None, zipcode=None, sort='name',
+               offset=0, limit=None):
+        """
+        Find restaurants in zipcode with a name containing words that
+        start with each word of name.  Either may be empty to match
+        anything; a zipcode that isn't a number matches nothing.
+        Returns the total number of matches, and the matches from
+        offset to offset + limit, ordered by sort.
+        """
+        if sort not in self.SORT_KEYS:
+            sort = 'name'
+        candidates = None
+        if zipcode:
+            candidates = set(self.by_zipcode.get(parse_zipcode(zipcode), ()))
+        for prefix in name_tokens(name or ''):
+            matches = self.match_prefix(prefix)
+            if candidates is None:
+                candidates = matches
+            else:
+                candidates &= matches
+        if candidates is None:
+            positions = self.order[sort]
+        else:
+            positions = sorted(candidates, key=self.rank[sort].__getitem__)
+        end = None if limit is None else offset + limit
+        return (len(positions),
+                [self.restaurants[pos] for pos in positions[offset:end]])
+
+class RestaurantSnapshot(object):
+    """
+    Every restaurant in the city as of a given time.
+    """
+    def __init__(self, restaurants, fetched):
+        self.restaurants = restaurants
+        self.fetched     = fetched
+        self._index      = None
+
+    def age(self, now=None):
+        return (now or datetime.now()) - self.fetched
+
+    def dumps(self):
+        """
+        Serialize the snapshot and its index in the binary format
+        described above.
+        """
+        import numpy as np
+        index = self.index
+        strings = StringTable()
+        records = np.zeros(len(self.restaurants), dtype=SNAPSHOT_RECORD)
+        records['name'] = [strings.add(r.name) for r in self.restaurants]
+        tables = OrderedDict()
+        for field, codebook in CODED_FIELDS.items():
+            codes = [getattr(r, field + '_code') for r in self.restaurants]
+            used = sorted(set(codes))
+            positions = dict((code, i) for i, code in enumerate(used))
+            records[field] = [positions[code] for code in codes]
+            tables['table:' + field] = [strings.add(codebook.values[code])
+                                        for code in used]
+        records['camis'] = [int(r.camis) for r in self.restaurants]
+        records['zipcode'] = [r.zipcode for r in self.restaurants]
+        records['score'] = [r.score for r in self.restaurants]
+        records['last_inspected'] = [r.last_inspected.toordinal()
+                                     for r in self.restaurants]
+
+        sections = OrderedDict()
+        sections['records'] = records
+        camis_positions = np.argsort(records['camis'], kind='mergesort')
+        sections['camis'] = records['camis'][camis_positions]
+        sections['camis_positions'] = camis_positions
+        zipcodes = sorted(index.by_zipcode)
+        (sections['zipcodes'], sections['zipcode_starts'],
+         sections['zipcode_positions']) = postings(
+            zipcodes, [index.by_zipcode[z] for z in zipcodes])
+        (sections['words'], sections['word_starts'],
+         sections['word_positions']) = postings(
+            [strings.add(w) for w in index.words],
+            [index.by_word[w] for w in index.words])
+        for key in RestaurantIndex.SORT_KEYS:
+            sections['order:' + key] = index.order[key]
+            sections['rank:' + key] = index.rank[key]
+        sections.update(tables)
+        sections['string_offsets'], sections['string_data'] = strings.arrays()
+        return pack_sections(sections, {
+            'fetched': self.fetched.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            'restaurants': len(self.restaurants),
+            })
+
+    @classmethod
+    def loads(cls, blob):
+        return MappedSnapshot(blob)
+
+    @property
+    def index(self):
+        """
+        A RestaurantIndex over this snapshot, built on first use.
+        """
+        if self._index is None:
+            self._index = RestaurantIndex(self.restaurants)
+        return self._index
+
+class StringTable(object):
+    """
+    Numbers distinct strings as they are added.
+    """
+    def __init__(self):
+        self.numbers = {}
+        self.strings = []
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        number = self.numbers.get(value)
+        if number is None:
+            number = self.numbers[value] = len(self.strings)
+            self.strings.append(value)
+        return number
+
+    def arrays(self):
+        """
+        The table as an array of offsets into an array of bytes.
+        """
+        import numpy as np
+        offsets = np.zeros(len(self.strings) + 1, dtype='<i4')
+        offsets[1:] = np.cumsum([len(v) for v in self.strings])
+        return offsets, np.fromstring(''.join(self.strings), dtype='S1')
+
+def postings(keys, lists):
+    """
+    Flatten lists of positions into keys, starts and positions arrays,
+    so that the positions for keys[i] are positions[starts[i]:
+    starts[i + 1]].
+    """
+    import numpy as np
+    starts = np.zeros(len(keys) + 1, dtype='<i4')
+    starts[1:] = np.cumsum([len(l) for l in lists])
+    positions = np.fromiter((pos for l in lists for pos in l), dtype='<i4',
+                            count=starts[-1])
+    return np.array(keys, dtype='<i4'), starts, positions
+
+def pack_sections(sections, header):
+    """
+    Lay out arrays after SNAPSHOT_MAGIC and a JSON header, each
+    8-byte aligned.  The header records where each one is.
+    """
+    import numpy as np
+    layout = {}
+    offset = 0
+    for name, array in sections.items():
+        array = np.asarray(array, dtype=SNAPSHOT_DTYPES.get(name, '<i4'))
+        sections[name] = array
+        layout[name] = (offset, len(array))
+        offset += -(-array.nbytes // 8) * 8
+    header = dict(header, sections=layout)
+    head = json.dumps(header)
+    head += ' ' * (-(len(SNAPSHOT_MAGIC) + 4 + len(head)) % 8)
+    out = [SNAPSHOT_MAGIC, struct.pack('<I', len(head)), head]
+    for array in sections.values():
+        data = array.tostring()
+        out.append(data)
+        out.append('\0' * (-len(data) % 8))
+    return ''.join(out)
+
+def unpack_sections(buf):
+    """
+    Read the header of a snapshot made by pack_sections.  Returns the
+    header and a dict of read-only arrays backed by buf.
+    """
+    import numpy as np
+    if buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError('not a restaurant snapshot')
+    start = len(SNAPSHOT_MAGIC) + 4
+    (length,) = struct.unpack('<I', buf[len(SNAPSHOT_MAGIC):start])
+    header = json.loads(buf[start:start + length])
+    base = start + length
+    sections = {}
+    for name, (offset, count) in header['sections'].items():
+        name = str(name)
+        sections[name] = np.frombuffer(
+            buf, dtype=SNAPSHOT_DTYPES.get(name, '<i4'), count=count,
+            offset=base + offset)
+    return header, sections
+
+class MappedStrings(object):
+    """
+    A read-only sequence of the strings numbered by a list of string
+    numbers, for bisecting.
+    """
+    def __init__(self, index, numbers):
+        self.index   = index
+        self.numbers = numbers
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, i):
+        return self.index.string(self.numbers[i])
+
+class MappedRecords(object):
+    """
+    A read-only sequence of RestaurantRecords, made as they are read.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index.records)
+
+    def __getitem__(self, pos):
+        return self.index.record(pos)
+
+    def __iter__(self):
+        for pos in xrange(len(self)):
+            yield self.index.record(pos)
+
+class MappedIndex(object):
+    """
+    A RestaurantIndex over the sections of a serialized snapshot.
+    Only the restaurants that are returned are turned into
+    RestaurantRecords.
+    """
+    SORT_KEYS = RestaurantIndex.SORT_KEYS
+
+    def __init__(self, sections):
+        self.records = sections['records']
+        self.string_offsets = sections['string_offsets']
+        self.string_data = sections['string_data']
+        self.camis = sections['camis']
+        self.camis_positions = sections['camis_positions']
+        self.zipcodes = sections['zipcodes']
+        self.zipcode_starts = sections['zipcode_starts']
+        self.zipcode_positions = sections['zipcode_positions']
+        self.words = MappedStrings(self, sections['words'])
+        self.word_starts = sections['word_starts']
+        self.word_positions = sections['word_positions']
+        self.order = dict((key, sections['order:' + key])
+                          for key in self.SORT_KEYS)
+        self.rank = dict((key, sections['rank:' + key])
+                         for key in self.SORT_KEYS)
+        self.codes = dict(
+            (field, [codebook.code(self.string(number))
+                     for number in sections['table:' + field]])
+            for field, codebook in CODED_FIELDS.items())
+        self.restaurants = MappedRecords(self)
+
+    def string(self, number):
+        start, end = self.string_offsets[number:number + 2]
+        return self.string_data[start:end].tostring()
+
+    def record(self, pos):
+        row = self.records[pos]
+        return RestaurantRecord.from_codes(
+            camis=str(row['camis']), name=self.string(row['name']),
+            zipcode=int(row['zipcode']),
+            codes=dict((field, codes[row[field]])
+                       for field, codes in self.codes.items()),
+            score=int(row['score']),
+            last_inspected=date.fromordinal(int(row['last_inspected'])))
+
+    def get(self, camis):
+        """
+        The restaurant with the given camis, or None.
+        """
+        import numpy as np
+        try:
+            camis = int(camis)
+        except ValueError:
+            return None
+        i = np.searchsorted(self.camis, camis)
+        if i == len(self.camis) or self.camis[i] != camis:
+            return None
+        return self.record(self.camis_positions[i])
+
+    def match_prefix(self, prefix):
+        """
+        The positions of restaurants with a word in their name
+        starting with prefix.
+        """
+        first = bisect.bisect_left(self.words, prefix)
+        last = first
+        while last < len(self.words) and self.words[last].startswith(prefix):
+            last += 1
+        return set(self.word_positions[self.word_starts[first]:
+                                       self.word_starts[last]].tolist())
+
+    def search(self, name=None, zipcode=None, sort='name',
+               offset=0, limit=None):
+        """
+        Like RestaurantIndex.search.
+        """
+        import numpy as np
+        if sort not in self.SORT_KEYS:
+            sort = 'name'
+        candidates = None
+        if zipcode:
+            zipcode = parse_zipcode(zipcode)
+            candidates = set()
+            i = (np.searchsorted(self.zipcodes, zipcode)
+                 if zipcode is not None else len(self.zipcodes))
+            if i < len(self.zipcodes) and self.zipcodes[i] == zipcode:
+                candidates = set(self.zipcode_positions[
+                    self.zipcode_starts[i]:self.zipcode_starts[i + 1]].tolist())
+        for prefix in name_tokens(name or ''):
+            matches = self.match_prefix(prefix)
+            if candidates is None:
+                candidates = matches
+            else:
+                candidates &= matches
+        if candidates is None:
+            positions = self.order[sort]
+        else:
+            positions = np.array(sorted(candidates), dtype='<i4')
+            positions = positions[np.argsort(self.rank[sort][positions],
+                                             kind='mergesort')]
+        end = None if limit is None else offset + limit
+        return (len(positions),
+                [self.record(pos) for pos in positions[offset:end]])
+
+class MappedSnapshot(RestaurantSnapshot):
+    """
+    A snapshot read in place from its serialized form, which may be a
+    string or a memory-mapped file.
+    """
+    def __init__(self, buf):
+        header, sections = unpack_sections(buf)
+        index = MappedIndex(sections)
+        RestaurantSnapshot.__init__(
+            self, index.restaurants,
+            datetime.strptime(header['fetched'], '%Y-%m-%dT%H:%M:%S.%f'))
+        self.buf = buf
+        self._index = index
+
+    def dumps(self):
+        return self.buf[:]
+
+def queue_snapshot_refresh():
+    """
+    Ask for the snapshot to be refreshed in the background.  Task
+    names are per-hour, so only one refresh is queued at a time.
+    """
+    try:
+        taskqueue.add(url='/updateres', method='GET',
+                      params={'action': 'snapshot'},
+                      name='snapshot-%s' % datetime.now().strftime('%Y%m%d%H'))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+class SnapshotMissing(Exception):
+    """
+    The snapshot asked for isn't the one saved in the backend.
+    """
+
+class SnapshotStore(object):
+    """
+    Loads, caches and refreshes the restaurant snapshot.
+
+    backend is anything with get(key) and set(key, blob).  fetch
+    downloads the whole city and queue_refresh arranges for refresh()
+    to be called later; both can be replaced for tests.
+    """
+    def __init__(self, backend, ttl=SNAPSHOT_TTL, fetch=None,
+                 queue_refresh=queue_snapshot_refresh):
+        self.backend       = backend
+        self.ttl           = ttl
+        self.fetch         = fetch or fetch_restaurants
+        self.queue_refresh = queue_refresh
+        self.snapshot      = None
+        self.checked       = None
+        # The page cache's SNAPSHOT_VERSION when the snapshot was last
+        # loaded by get_version.
+        self.version       = None
+
+    def save(self, restaurants):
+        """
+        Save a freshly downloaded list of every restaurant as the
+        current snapshot.
+        """
+        snapshot = RestaurantSnapshot(restaurants, datetime.now())
+        self.backend.set(SNAPSHOT_KEY, snapshot.dumps())
+        self.snapshot = snapshot
+        self.checked  = snapshot.fetched
+        page_cache.invalidate_snapshot()
+        return snapshot
+
+    def refresh(self):
+        """
+        Download a new snapshot and save it.
+        """
+        return self.save(self.fetch())
+
+    def get(self):
+        """
+        Returns the current snapshot.  A stale snapshot is returned
+        as-is, after queueing a refresh.  We never wait for the DoH
+        site here: if no snapshot has been saved yet, an empty one is
+        returned until the queued refresh has made one.
+        """
+        now = datetime.now()
+        if ((self.snapshot is None or self.snapshot.age(now) > self.ttl) and
+            (self.checked is None or now - self.checked > SNAPSHOT_RECHECK)):
+            # Another instance may have refreshed it already.
+            self.checked = now
+            blob = self.backend.get(SNAPSHOT_KEY)
+            if blob is not None:
+                self.snapshot = RestaurantSnapshot.loads(blob)
+            if self.snapshot is None or self.snapshot.age(now) > self.ttl:
+                self.queue_refresh()
+        if self.snapshot is None:
+            return RestaurantSnapshot([], datetime.min)
+        return self.snapshot
+
+    def get_version(self, version):
+        """
+        Like get, but for a page cached under version, the page cache's
+        SNAPSHOT_VERSION.  If this instance hasn't loaded the snapshot
+        since the version became that, it is reloaded from the backend
+        first: a new snapshot is saved before the version is bumped, so
+        a page cached under version never shows an older one.
+        """
+        if version != self.version:
+            blob = self.backend.get(SNAPSHOT_KEY)
+            if blob is not None:
+                self.snapshot = RestaurantSnapshot.loads(blob)
+                self.checked  = datetime.now()
+            self.version = version
+        return self.get()
+
+    def load(self, fetched):
+        """
+        Returns the snapshot fetched at fetched, from this instance if
+        it has it, or else from the backend however recently it was
+        checked.  Raises SnapshotMissing if the backend holds some
+        other snapshot, or none.
+        """
+        if self.snapshot is not None and self.snapshot.fetched == fetched:
+            return self.snapshot
+        blob = self.backend.get(SNAPSHOT_KEY)
+        snapshot = RestaurantSnapshot.loads(blob) if blob is not None else None
+        if snapshot is None or snapshot.fetched != fetched:
+            raise SnapshotMissing('snapshot of %s is not saved' % fetched)
+        self.snapshot = snapshot
+        self.checked  = datetime.now()
+        return snapshot
+
+# Keep snapshots in files under SNAPSHOT_DIR rather than the
+# datastore, if it is set.
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR')
+
+snapshot_store = SnapshotStore(FileBackend(SNAPSHOT_DIR) if SNAPSHOT_DIR
+                               else DatastoreBackend())
+
+def search_restaurants(name=None, zipcode=None, sort='name',
+                       offset=0, limit=None):
+    """
+    Search the local snapshot.  See RestaurantIndex.search.
+    """
+    return snapshot_store.get().index.search(name, zipcode, sort,
+                                             offset, limit)
+
+def find_restaurants(name=None, zipcode=None):
+    """
+    Find restaurants by name and/or zipcode in the local snapshot.
+    Returns a list of RestaurantRecords.
+    """
+    return search_restaurants(name, zipcode)[1]
+
+# -------------------------------------------------------------------
+# Citywide analytics
+#
+# For aggregate views, the snapshot is also kept as columns: one numpy
+# array per field, with strings replaced by codes.  Grade
+# distributions, score percentiles and trends are then computed with
+# array operations rather than loops over restaurants.  The columns
+# are rebuilt from each new snapshot, and patched with the changes
+# each update finds in between.
+#
+
+CITYWIDE_KEY = 'citywide'
+# Score percentiles shown for each zipcode and cuisine.
+SCORE_PERCENTILES = (25, 50, 75, 90)
+# Months of inspections in the score trend.
+TREND_MONTHS = 12
+
+def encode_strings(values, labels=None):
+    """
+    Replace strings by their position in labels, adding new ones to
+    the end.  Returns the codes as an array, and labels.
+    """
+    import numpy as np
+    labels = list(labels or ())
+    codes = dict((label, i) for i, label in enumerate(labels))
+    column = []
+    for value in values:
+        if value not in codes:
+            codes[value] = len(labels)
+            labels.append(value)
+        column.append(codes[value])
+    return np.array(column, dtype=np.int32), labels
+
+def inspection_month(day):
+    return day.year * 12 + day.month - 1
+
+class CitywideStats(object):
+    """
+    The citywide snapshot as columns.  cuisine and grade hold codes
+    into cuisines and grades.  prev_score is each restaurant's score
+    before the last change we saw, or -1 if we haven't seen one, and
+    month counts months since year 0.  Columns are sorted by camis.
+    """
+    COLUMNS = ('camis', 'zipcode', 'cuisine', 'grade', 'score',
+               'prev_score', 'month')
+
+    def __init__(self, built, cuisines, grades, columns):
+        self.built    = built
+        self.cuisines = cuisines
+        self.grades   = grades
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    @classmethod
+    def from_snapshot(cls, snapshot, previous=None):
+        """
+        Build the columns for a RestaurantSnapshot.  prev_score is
+        carried over from previous, or taken from its score where that
+        has changed.
+        """
+        import numpy as np
+        records = sorted(snapshot.restaurants, key=lambda r: int(r.camis))
+        cuisine, cuisines = encode_strings(r.cuisine for r in records)
+        grade, grades = encode_strings(r.grade for r in records)
+        columns = {
+            'camis':   np.array([int(r.camis) for r in records], dtype=np.int64),
+            'zipcode': np.array([r.zipcode for r in records], dtype=np.int32),
+            'cuisine': cuisine,
+            'grade':   grade,
+            'score':   np.array([r.score for r in records], dtype=np.int32),
+            'month':   np.array([inspection_month(r.last_inspected)
+                                 for r in records], dtype=np.int32),
+            }
+        columns['prev_score'] = np.empty(len(records), dtype=np.int32)
+        columns['prev_score'].fill(-1)
+        citywide = cls(snapshot.fetched, cuisines, grades, columns)
+        if previous is not None:
+            found, rows = previous.lookup(citywide.camis)
+            old_score = previous.score[rows[found]]
+            old_prev = previous.prev_score[rows[found]]
+            new_score = citywide.score[found]
+            citywide.prev_score[found] = np.where(old_score != new_score,
+                                               old_score, old_prev)
+        return citywide
+
+    def lookup(self, camis):
+        """
+        Find an array of camis.  Returns a boolean array saying which
+        were found, and the row each would be at.
+        """
+        import numpy as np
+        rows = np.searchsorted(self.camis, camis)
+        rows = np.minimum(rows, max(len(self.camis) - 1, 0))
+        if not len(self.camis):
+            return np.zeros(len(camis), dtype=bool), rows
+        return self.camis[rows] == camis, rows
+
+    def apply(self, updates, now=None):
+        """
+        Patch in RestaurantRecords for restaurants whose grade, score
+        or inspection changed.  Restaurants we don't have are ignored
+        until the next snapshot.
+        """
+        import numpy as np
+        camis = np.array([int(r.camis) for r in updates], dtype=np.int64)
+        found, rows = self.lookup(camis)
+        rows = rows[found]
+        updates = [r for r, f in zip(updates, found) if f]
+        score = np.array([r.score for r in updates], dtype=np.int32)
+        grade, self.grades = encode_strings((r.grade for r in updates),
+                                            self.grades)
+        changed = self.score[rows] != score
+        self.prev_score[rows[changed]] = self.score[rows[changed]]
+        self.score[rows] = score
+        self.grade[rows] = grade
+        self.month[rows] = [inspection_month(r.last_inspected)
+                            for r in updates]
+        self.built = now or datetime.now()
+
+    def group(self, by):
+        """
+        The labels and per-restaurant group codes for grouping by
+        'zipcode' or 'cuisine'.
+        """
+        import numpy as np
+        if by == 'cuisine':
+            return self.cuisines, self.cuisine
+        labels, codes = np.unique(self.zipcode, return_inverse=True)
+        return [int(z) for z in labels], codes
+
+    def grade_distribution(self, by):
+        """
+        Returns a list of (label, restaurants, counts) for each group,
+        with counts in the order of sorted(grades).
+        """
+        import numpy as np
+        # numpy 1.6's bincount rejects an empty array.
+        if not len(self.camis):
+            return []
+        labels, codes = self.group(by)
+        width = len(self.grades)
+        counts = np.bincount(codes * width + self.grade,
+                             minlength=len(labels) * width)
+        counts = counts.reshape(len(labels), width)[:, np.argsort(self.grades)]
+        return [(label, int(row.sum()), [int(n) for n in row])
+                for label, row in zip(labels, counts)]
+
+    def score_percentiles(self, by, percentiles=SCORE_PERCENTILES):
+        """
+        Returns a list of (label, restaurants, scores) for each group,
+        with a score at each of percentiles, interpolated as numpy's
+        percentile does.
+        """
+        import numpy as np
+        if not len(self.camis):
+            return []
+        labels, codes = self.group(by)
+        order = np.lexsort((self.score, codes))
+        scores = self.score[order].astype(np.float64)
+        starts = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+        sizes = starts[1:] - starts[:-1]
+        columns = []
+        for p in percentiles:
+            pos = starts[:-1] + (sizes - 1) * (p / 100.0)
+            low = np.floor(pos).astype(np.int64)
+            high = np.ceil(pos).astype(np.int64)
+            columns.append(scores[low] + (scores[high] - scores[low]) *
+                           (pos - low))
+        return [(label, int(size), [float(c[i]) for c in columns])
+                for i, (label, size) in enumerate(zip(labels, sizes))]
+
+    def score_trend(self, months=TREND_MONTHS):
+        """
+        Returns a list of (month, inspections, mean score) for the
+        last months months with inspections, where month is 'YYYY-MM'.
+        """
+        import numpy as np
+        if not len(self.month):
+            return []
+        recent = self.month > self.month.max() - months
+        labels, codes = np.unique(self.month[recent], return_inverse=True)
+        totals = np.bincount(codes, weights=self.score[recent])
+        counts = np.bincount(codes)
+        return [('%d-%02d' % (m // 12, m % 12 + 1), int(n), float(t) / n)
+                for m, n, t in zip(labels, counts, totals)]
+
+    def worsened(self, limit=20):
+        """
+        Returns a list of (camis, prev_score, score) for the restaurants
+        whose scores rose the most, worst first.  Higher scores mean
+        more violations.
+        """
+        import numpy as np
+        rows = np.flatnonzero(self.prev_score >= 0)
+        rise = self.score[rows] - self.prev_score[rows]
+        rows = rows[rise > 0]
+        rise = rise[rise > 0]
+        rows = rows[np.argsort(-rise, kind='mergesort')[:limit]]
+        return [(str(self.camis[i]), int(self.prev_score[i]),
+                 int(self.score[i])) for i in rows]
+
+    def dumps(self):
+        columns = dict((name, getattr(self, name)) for name in self.COLUMNS)
+        return zlib.compress(pickle.dumps(
+            (self.built, self.cuisines, self.grades, columns),
+            pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def loads(cls, blob):
+        return cls(*pickle.loads(zlib.decompress(blob)))
+
+class CitywideStore(object):
+    """
+    Keeps CitywideStats in a snapshot backend.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self):
+        blob = self.backend.get(CITYWIDE_KEY)
+        if blob is None:
+            return None
+        return CitywideStats.loads(blob)
+
+    def rebuild(self, snapshot):
+        """
+        Rebuild the columns from a new snapshot.
+        """
+        citywide = CitywideStats.from_snapshot(snapshot, self.get())
+        self.backend.set(CITYWIDE_KEY, citywide.dumps())
+        page_cache.invalidate_citywide()
+        return citywide
+
+    def apply(self, updates):
+        """
+        Patch in changed RestaurantRecords between snapshots.
+        """
+        citywide = self.get()
+        if citywide is None or not updates:
+            return
+        citywide.apply(updates)
+        self.backend.set(CITYWIDE_KEY, citywide.dumps())
+        page_cache.invalidate_citywide()
+
+citywide_store = CitywideStore(DatastoreBackend())
+
+# -------------------------------------------------------------------
+# Refreshing restaurants
+#
+
+# Most zipcodes to download from the DoH site at once.
+FETCH_PARALLELISM = 8
+# Least number of seconds between starting two requests to the DoH site.
+FETCH_INTERVAL = 0.2
+# Restaurants per page when downloading the whole city.
+CITYWIDE_CHUNK_SIZE = 5000
+
+class RateLimiter(object):
+    """
+    Spaces calls to wait() so that they return at least interval
+    seconds apart, across threads.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.next     = 0
+        self.lock     = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+# All requests go to the same DoH host, so they share one limiter.
+doh_rate_limiter = RateLimiter(FETCH_INTERVAL)
+
+def fetch_limited(fetch, kwargs, limiter=doh_rate_limiter):
+    """
+    Call fetch(**kwargs) once limiter allows it.  Retries happen in
+    DohClient.
+    """
+    limiter.wait()
+    return fetch(**kwargs)
+
+def fetch_all(requests, fetch=None, parallelism=FETCH_PARALLELISM,
+              limiter=doh_rate_limiter):
+    """
+    Call fetch(**kwargs) for each kwargs dict in requests, with up to
+    parallelism calls in flight.  Yields (kwargs, restaurants, error)
+    as each call finishes, so the caller can work on one result while
+    the others are still downloading.  error is None, or the
+    exception that the call failed with.
+    """
+    fetch = fetch or fetch_restaurants
+    todo = Queue.Queue()
+    for kwargs in requests:
+        todo.put(kwargs)
+    done = Queue.Queue()
+    collector = stats.current()
+
+    def worker():
+        stats.bind(collector)
+        while True:
+            try:
+                kwargs = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((kwargs,
+                          fetch_limited(fetch, kwargs, limiter),
+                          None))
+            except Exception as e:
+                done.put((kwargs, None, e))
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(parallelism, len(requests)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for i in range(len(requests)):
+        yield done.get()
+    for thread in threads:
+        thread.join()
+
+def fetch_zipcodes(zipcodes, fetch=None, parallelism=FETCH_PARALLELISM,
+                   limiter=doh_rate_limiter):
+    """
+    Download the restaurants in each zipcode in parallel.  Yields
+    (zipcode, restaurants, error) as each one finishes; see
+    fetch_all.
+    """
+    for kwargs, restaurants, error in fetch_all(
+        [{'zipcode': zipcode} for zipcode in zipcodes],
+        fetch, parallelism, limiter):
+        yield kwargs['zipcode'], restaurants, error
+
+def fetch_citywide(expected, chunk_size=CITYWIDE_CHUNK_SIZE, fetch=None,
+                   parallelism=FETCH_PARALLELISM, limiter=doh_rate_limiter):
+    """
+    Download every restaurant in the city, as pages of chunk_size
+    results fetched in parallel.  expected is a guess at how many
+    restaurants there are; if the last page comes back full, we keep
+    going one page at a time.  Returns a list of RestaurantRecords.
+    Raises the first error that a page failed with.
+    """
+    pages = expected // chunk_size + 1
+    requests = [{'first': i * chunk_size + 1, 'last': (i + 1) * chunk_size}
+                for i in range(pages)]
+    results = {}
+    while requests:
+        for kwargs, restaurants, error in fetch_all(requests, fetch,
+                                                    parallelism, limiter):
+            if error is not None:
+                raise error
+            results[kwargs['first']] = restaurants
+        last = max(results)
+        if len(results[last]) < chunk_size:
+            break
+        requests = [{'first': last + chunk_size,
+                     'last': last + 2 * chunk_size - 1}]
+    restaurants = []
+    for first in sorted(results):
+        restaurants.extend(results[first])
+    return restaurants
+
+# -------------------------------------------------------------------
+# Fetch planning
+#
+# The nightly update can either ask the DoH site for each subscribed
+# zipcode, or download the whole city in a few large pages.  Which is
+# cheaper depends on how many zipcodes there are, so FetchPlanner
+# estimates both from the timings of recent runs, each of which is
+# recorded as a RefreshRun.
+#
+
+# Guesses used until there is history to go on.
+DEFAULT_CITYWIDE_RESTAURANTS = 28000
+DEFAULT_ZIPCODE_SECONDS = 5.0
+DEFAULT_CHUNK_SECONDS = 30.0
+# How many recent runs to estimate from.
+PLANNER_HISTORY = 10
+
+class RefreshRun(db.Model):
+    """
+    How one refresh went: which strategy was picked and why, and how
+    long the DoH site took.
+    """
+    started   = db.DateTimeProperty(auto_now_add=True)
+    strategy  = db.StringProperty(choices=set(['zipcode', 'citywide', 'bulk']))
+    zipcodes  = db.IntegerProperty()
+    estimated_zipcode_seconds  = db.FloatProperty()
+    estimated_citywide_seconds = db.FloatProperty()
+    requests         = db.IntegerProperty(default=0)
+    request_seconds  = db.FloatProperty(default=0.0)
+    restaurants      = db.IntegerProperty(default=0)
+    seconds          = db.FloatProperty()
+    zipcodes_skipped   = db.IntegerProperty(default=0)
+    zipcodes_processed = db.IntegerProperty(default=0)
+    zipcodes_failed    = db.IntegerProperty(default=0)
+    # When the snapshot a citywide job's units reconcile against was
+    # fetched.
+    snapshot  = db.DateTimeProperty()
+
+    @property
+    def seconds_per_request(self):
+        if not self.requests:
+            return None
+        return self.request_seconds / self.requests
+
+class FetchTimer(object):
+    """
+    Wraps a fetch function to count requests, the time they took and
+    the restaurants they returned, across threads.
+    """
+    def __init__(self, fetch=None):
+        self.fetch       = fetch or fetch_restaurants
+        self.lock        = threading.Lock()
+        self.requests    = 0
+        self.seconds     = 0.0
+        self.restaurants = 0
+
+    def __call__(self, **kwargs):
+        start = time.time()
+        restaurants = self.fetch(**kwargs)
+        with self.lock:
+            self.requests    += 1
+            self.seconds     += time.time() - start
+            self.restaurants += len(restaurants or ())
+        return restaurants
+
+class FetchPlanner(object):
+    """
+    Picks between per-zipcode and citywide downloads for a refresh.
+    """
+    def __init__(self, history, parallelism=FETCH_PARALLELISM,
+                 chunk_size=CITYWIDE_CHUNK_SIZE):
+        self.parallelism = parallelism
+        self.chunk_size  = chunk_size
+        self.zipcode_seconds = self.average(history, 'zipcode',
+                                            DEFAULT_ZIPCODE_SECONDS)
+        self.chunk_seconds   = self.average(history, 'citywide',
+                                            DEFAULT_CHUNK_SECONDS)
+        citywide = [run.restaurants for run in history
+                    if run.strategy == 'citywide' and run.restaurants]
+        if citywide:
+            self.citywide_restaurants = citywide[0]
+        else:
+            self.citywide_restaurants = DEFAULT_CITYWIDE_RESTAURANTS
+
+    @classmethod
+    def from_history(cls, **kwargs):
+        return cls(RefreshRun.all().order('-started').fetch(PLANNER_HISTORY),
+                   **kwargs)
+
+    @staticmethod
+    def average(history, strategy, default):
+        timings = [run.seconds_per_request for run in history
+                   if run.strategy == strategy and run.requests]
+        if not timings:
+            return default
+        return sum(timings) / len(timings)
+
+    def rounds(self, requests):
+        """
+        How many rounds of parallel requests it takes to make requests.
+        """
+        return -(-requests // self.parallelism)
+
+    def estimate_zipcode(self, zipcodes):
+        return self.rounds(zipcodes) * self.zipcode_seconds
+
+    def estimate_citywide(self):
+        pages = self.citywide_restaurants // self.chunk_size + 1
+        return self.rounds(pages) * self.chunk_seconds
+
+    def plan(self, zipcodes):
+        """
+        Returns a RefreshRun recording the strategy to use for a
+        refresh of that many zipcodes.
+        """
+        run = RefreshRun(zipcodes=zipcodes,
+                         estimated_zipcode_seconds=self.estimate_zipcode(zipcodes),
+                         estimated_citywide_seconds=self.estimate_citywide())
+        if run.estimated_citywide_seconds < run.estimated_zipcode_seconds:
+            run.strategy = 'citywide'
+        else:
+            run.strategy = 'zipcode'
+        return run
+
+class ZipcodeDigest(db.Model):
+    """
+    Fingerprints of what the DoH site said about a zipcode last time:
+    the SHA-1 of the raw response (when it was fetched by itself), and
+    of the restaurants' fields.  checked is when the stored
+    restaurants were last brought in line with them.
+    """
+    raw     = db.StringProperty(indexed=False)
+    records = db.StringProperty(indexed=False)
+    checked = db.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def make_key(cls, zipcode):
+        return db.Key.from_path('ZipcodeDigest', str(zipcode))
+
+    def settled(self, restaurants):
+        """
+        Whether none of restaurants has changed since the digests
+        were taken, so that matching digests mean nothing to do.  A
+        restaurant subscribed to since then may have been copied from
+        an older snapshot, so it needs reconciling anyway.
+        """
+        return (self.checked is not None and
+                all(r.last_updated <= self.checked for r in restaurants))
+
+def records_digest(restaurants):
+    """
+    A fingerprint of the fields of restaurants, in any order.
+    """
+    rows = sorted(tuple(getattr(r, f) for f in RestaurantRecord.FIELDS)
+                  for r in restaurants)
+    return hashlib.sha1(repr(rows)).hexdigest()
+
+class ConditionalFetch(object):
+    """
+    Fetches like fetch_restaurants, but returns None for a zipcode
+    whose response matches the raw digest in known.  The digests of
+    the responses are collected in digests.
+    """
+    def __init__(self, known):
+        self.known   = known
+        self.digests = {}
+
+    def __call__(self, zipcode=None, **kwargs):
+        if zipcode is None:
+            return fetch_restaurants(**kwargs)
+        digest, restaurants = fetch_zipcode_if_changed(
+            zipcode, self.known.get(zipcode))
+        self.digests[zipcode] = digest
+        return restaurants
+
+def restaurant_changed(restaurant, update):
+    """
+    Whether the DoH site has a new grade, score or inspection for a
+    stored restaurant.
+    """
+    return (restaurant.grade != update.grade or
+            restaurant.score != update.score or
+            restaurant.last_inspected != update.last_inspected)
+
+@stats.timed('reconcile')
+def reconcile(restaurants, updates):
+    """
+    Match stored Restaurants against fresh RestaurantRecords by camis.
+
+    Returns a list of (restaurant, update) pairs for the restaurants
+    that changed, and a dict counting updates that are 'added' (we
+    don't store them), 'changed' and 'unchanged', and stored
+    restaurants that are 'missing' from the updates.
+    """
+    by_camis = dict((r.key().id_or_name(), r) for r in restaurants)
+    changed = []
+    counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+    for update in updates:
+        restaurant = by_camis.pop(update.camis, None)
+        if restaurant is None:
+            counts['added'] += 1
+        elif restaurant_changed(restaurant, update):
+            changed.append((restaurant, update))
+            counts['changed'] += 1
+        else:
+            counts['unchanged'] += 1
+    counts['missing'] = len(by_camis)
+    return changed, counts
+
+# -------------------------------------------------------------------
+# Notifications
+#
+# A notify run only looks at the ChangeEvents recorded since the last
+# run, finds the users subscribed to those restaurants, and notifies
+# those users in shards.  Each user has their own cursor into the
+# events, so they hear about every change exactly once.  A shard reads
+# the events after its users' earliest cursor once, and each user only
+# looks at those for the restaurants they subscribe to.  Shards are
+# handed to an executor: in production each one is a task queue task,
+# and LocalExecutor runs them in this process.
+#
+
+# Users per notification shard.
+NOTIFY_SHARD_SIZE = 50
+
+class NotifyState(db.Model):
+    """
+    Singleton recording the last ChangeEvent seen by a notify run.
+    """
+    KEY_NAME = 'notify'
+    sequence = db.IntegerProperty(default=0)
+
+# Where links in emails point, and who they come from.
+APP_URL = 'http://%s' % os.environ.get('DEFAULT_VERSION_HOSTNAME',
+                                       'nyc-restaurant-grades.appspot.com')
+NOTIFY_SENDER = 'notifier@nyc-restaurant-grades.appspotmail.com'
+DIGEST_SUBJECT = 'Restaurant Grades Updated!'
+# Emails sent at once, and digests handed to each sender at a time.
+MAIL_CONCURRENCY = 4
+MAIL_BATCH_SIZE = 10
+
+class Digest(object):
+    """
+    One user's email: the restaurants they subscribe to that changed,
+    each with the descriptions of its changes.  cursor is the sequence
+    number the user's cursor moves to once it is sent.
+    """
+    def __init__(self, user, items, cursor=None):
+        self.user   = user
+        self.items  = items
+        self.cursor = cursor
+
+    def render(self):
+        """
+        Returns the text and HTML bodies.
+        """
+        values = {'items': self.items, 'app_url': APP_URL}
+        return (jinja_environment.get_template('digest.txt').render(values),
+                jinja_environment.get_template('digest.html').render(values))
+
+def shard_events(users, last):
+    """
+    Read what a shard of users needs to hear about, up to sequence
+    number last.  Returns the camis each user subscribes to, as a dict
+    by user key, and the ChangeEvents after the earliest of their
+    cursors for any of those camis, as a dict of camis to events in
+    order.  The events are read with a single query for the shard.
+    """
+    queries = [(user.key(), Subscription.all(keys_only=True).ancestor(user)
+                .run(batch_size=DATASTORE_BATCH_SIZE)) for user in users]
+    subscribed = dict((user_key, set(key.id_or_name() for key in keys))
+                      for user_key, keys in queries)
+    wanted = set().union(*subscribed.values())
+    events = defaultdict(list)
+    cursor = min([user.event_cursor or 0 for user in users] or [last])
+    if wanted and cursor < last:
+        query = events_after(cursor).filter('sequence <=', last)
+        for event in query.run(batch_size=DATASTORE_BATCH_SIZE):
+            if event.camis in wanted:
+                events[event.camis].append(event)
+    return subscribed, events
+
+def build_digest(user, subscribed, events, last):
+    """
+    The Digest of the ChangeEvents after user's cursor for the
+    restaurants they subscribe to, or None if nothing they asked to
+    hear about changed.  subscribed and events are from shard_events,
+    and last is the sequence number it read up to, which is returned
+    as the number to move their cursor to.
+    """
+    cursor = user.event_cursor or 0
+    if cursor >= last:
+        return None, cursor
+    by_camis = {}
+    for camis in subscribed:
+        unseen = [event for event in events.get(camis, ())
+                  if event.sequence > cursor]
+        if unseen:
+            by_camis[camis] = unseen
+    if not by_camis:
+        return None, last
+    user_id = user.key().id_or_name()
+    subscriptions = prefetch_subscriptions(
+        [sub for sub in db.get([Subscription.make_key(user_id, camis)
+                                for camis in sorted(by_camis)])
+         if sub is not None],
+        user)
+    items = []
+    for sub in subscriptions:
+        camis = sub.key().id_or_name()
+        changes = [event.describe() for event in by_camis[camis]
+                   if event.should_notify(sub)]
+        if changes:
+            items.append({'camis': camis,
+                          'name': sub.restaurant.name,
+                          'changes': changes})
+    digest = Digest(user, items, last) if items else None
+    return digest, last
+
+class AppEngineMailTransport(object):
+    """
+    Sends email with the App Engine mail API.
+    """
+    def send(self, sender, to, subject, body, html):
+        mail.send_mail(sender, to, subject, body, html=html)
+
+class CaptureTransport(object):
+    """
+    Keeps messages instead of sending them.  For tests and the dev
+    server.
+    """
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.messages = []
+
+    def send(self, sender, to, subject, body, html):
+        with self.lock:
+            self.messages.append({'sender': sender, 'to': to,
+                                  'subject': subject, 'body': body,
+                                  'html': html})
+
+# Set MAIL_TRANSPORT to 'capture' to keep mail from being sent.
+if os.environ.get('MAIL_TRANSPORT') == 'capture':
+    mail_transport = CaptureTransport()
+else:
+    mail_transport = AppEngineMailTransport()
+
+class DeliveryQueue(object):
+    """
+    Collects digests, then sends them in batches, up to concurrency
+    at a time.  The mail API has no asynchronous send, so each batch
+    is sent from its own thread.  Records how many were sent or
+    failed and how long it took.
+    """
+    def __init__(self, transport=None, concurrency=MAIL_CONCURRENCY,
+                 batch_size=MAIL_BATCH_SIZE):
+        self.transport   = transport or mail_transport
+        self.concurrency = concurrency
+        self.batch_size  = batch_size
+        self.pending     = []
+        self.sent        = []
+        self.failed      = []
+        self.seconds     = 0.0
+        self.lock        = threading.Lock()
+
+    def add(self, digest):
+        self.pending.append(digest)
+
+    def deliver(self, digest):
+        """
+        Send one digest.  The user's cursor is saved first, so a run
+        killed after sending can't send it again; if sending fails,
+        the cursor is put back.
+        """
+        previous = mark_delivery(digest.user, digest.cursor)
+        if previous is None:
+            logging.info('digest to %s already sent', digest.user.email)
+            return
+        body, html = digest.render()
+        try:
+            self.transport.send(NOTIFY_SENDER, digest.user.email,
+                                DIGEST_SUBJECT, body, html)
+        except Exception:
+            unmark_delivery(digest.user, digest.cursor, previous)
+            raise
+
+    def send_batch(self, digests):
+        for digest in digests:
+            try:
+                self.deliver(digest)
+            except Exception as e:
+                logging.error('mail to %s failed: %s', digest.user.email, e)
+                with self.lock:
+                    self.failed.append(digest)
+            else:
+                with self.lock:
+                    self.sent.append(digest)
+
+    def flush(self):
+        """
+        Send everything pending.  Returns the digests that were sent.
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return []
+        already_sent = len(self.sent)
+        start = time.time()
+        with stats.span('mail.deliver'):
+            LocalExecutor(self.concurrency).map(
+                self.send_batch, batches(pending, self.batch_size))
+        seconds = time.time() - start
+        self.seconds += seconds
+        sent = self.sent[already_sent:]
+        stats.count('mail.sent', len(sent))
+        stats.count('mail.failed', len(pending) - len(sent))
+        logging.info('sent %d of %d digests in %.2fs (%.1f/s)',
+                     len(sent), len(pending), seconds,
+                     len(sent) / seconds if seconds else 0)
+        return sent
+
+    @property
+    def rate(self):
+        return len(self.sent) / self.seconds if self.seconds else None
+
+def mark_delivery(user, cursor):
+    """
+    Move user's stored cursor to cursor, as their digest is about to
+    be sent.  Returns the cursor it had, or None if it had already
+    moved that far, in which case the digest was sent by an earlier
+    run and mustn't be sent again.
+    """
+    def txn():
+        stored = db.get(user.key())
+        if (stored.event_cursor or 0) >= cursor:
+            return None
+        previous = stored.event_cursor or 0
+        stored.event_cursor = cursor
+        stored.last_notified = datetime.now()
+        stored.put()
+        return previous
+    previous = db.run_in_transaction(txn)
+    if previous is not None:
+        user.event_cursor = cursor
+        user.last_notified = datetime.now()
+    return previous
+
+def unmark_delivery(user, cursor, previous):
+    """
+    Put user's cursor back after their digest failed to send, unless
+    something else has moved it since mark_delivery.
+    """
+    def txn():
+        stored = db.get(user.key())
+        if stored.event_cursor == cursor:
+            stored.event_cursor = previous
+            stored.put()
+    db.run_in_transaction(txn)
+    user.event_cursor = previous
+
+@stats.timed('notify_users')
+def notify_users(users, transport=None):
+    """
+    Email each of users about the ChangeEvents after their cursor,
+    and move their cursors past them.  Each user with a digest has
+    their cursor saved just before it is sent (see
+    DeliveryQueue.deliver); a user whose email fails keeps their old
+    cursor, so they are tried again next time.  The cursors of users
+    with nothing to hear about are moved with one batched put.  The
+    cached home pages of users who were sent a digest are invalidated.
+    Returns the DeliveryQueue.
+    """
+    queue = DeliveryQueue(transport)
+    cursors = {}
+    # Every event up to last is stored, as events are put in the
+    # transaction that numbers them.
+    last = current_sequence()
+    subscribed, events = shard_events(users, last)
+    for user in users:
+        digest, cursors[user.key()] = build_digest(
+            user, subscribed[user.key()], events, last)
+        if digest is not None:
+            queue.add(digest)
+    mailed = set(digest.user.key() for digest in queue.pending)
+    queue.flush()
+    # Sending moved last_notified, which the home page shows.
+    for digest in queue.sent:
+        page_cache.invalidate_user(digest.user.key().name())
+    changed = []
+    for user in users:
+        if (user.key() in mailed or
+            cursors[user.key()] == user.event_cursor):
+            continue
+        user.event_cursor = cursors[user.key()]
+        changed.append(user)
+    put_in_batches(changed)
+    return queue
+
+def notify_user(user):
+    """
+    Email one user about their changed subscriptions.
+    """
+    return notify_users([user])
+
+def notify_shard(user_keys):
+    """
+    Notify a shard of users.  Runs as a task, so it must only take
+    picklable arguments.
+    """
+    notify_users([user for user in db.get(user_keys) if user is not None])
+
+def affected_users(events):
+    """
+    The keys of users subscribed to a restaurant with one of events.
+    """
+    return list(RestaurantSubscribers.lookup(
+        set(event.camis for event in events)))
+
+def notify_all(executor, shard_size=NOTIFY_SHARD_SIZE):
+    """
+    Notify every user affected by ChangeEvents since the last run.
+    Users with no changed subscriptions are skipped without being
+    loaded.  Returns the number of users notified.
+    """
+    state = NotifyState.get_or_insert(NotifyState.KEY_NAME)
+    events = list(events_after(state.sequence))
+    if not events:
+        return 0
+    users = affected_users(events)
+    executor.map(notify_shard, batches(users, shard_size))
+    logging.info('notifying %d users of %d changes after event %d',
+                 len(users), len(events), state.sequence)
+    state.sequence = events[-1].sequence
+    state.put()
+    return len(users)
+
+class LocalExecutor(object):
+    """
+    Runs shards in this process, up to parallelism at a time.
+    """
+    def __init__(self, parallelism=FETCH_PARALLELISM):
+        self.parallelism = parallelism
+
+    def map(self, func, shards):
+        todo = Queue.Queue()
+        for shard in shards:
+            todo.put(shard)
+        collector = stats.current()
+
+        def worker():
+            stats.bind(collector)
+            while True:
+                try:
+                    shard = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                func(shard)
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.parallelism, len(shards)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+class TaskQueueExecutor(object):
+    """
+    Runs each shard as a deferred task.
+    """
+    def __init__(self, queue_name='default'):
+        self.queue_name = queue_name
+
+    def map(self, func, shards):
+        for shard in shards:
+            deferred.defer(func, shard, _queue=self.queue_name)
+
+# -------------------------------------------------------------------
+# Resumable jobs
+#
+# The nightly update and notify runs are split into units of work (a
+# zipcode to refresh, a shard of users to notify) that are saved to
+# the datastore before any of them start.  Runners claim units with a
+# lease, do them, and mark them done, so a run that is killed part way
+# is picked up where it left off, and several runners can share one
+# job.  A runner stops after JOB_REQUEST_SECONDS and queues a task to
+# carry on from its query cursor.  Units are safe to run twice:
+# restaurants that were already updated reconcile as unchanged, and
+# users whose cursors moved on aren't mailed again.
+#
+
+# Seconds a runner works before handing off to a new task.
+JOB_REQUEST_SECONDS = 8 * 60
+# How long a claimed unit is left alone before another runner may
+# assume its runner died.
+JOB_LEASE = timedelta(minutes=10)
+# Units a runner fetches at a time.
+JOB_PAGE_SIZE = 20
+# Runners started for each job.
+JOB_RUNNERS = 4
+# Tries before a unit is given up on.
+JOB_MAX_ATTEMPTS = 3
+
+class Job(db.Model):
+    """
+    One run of a nightly job.  The key name is the kind and the day, so
+    starting it again the same day resumes it.
+    """
+    kind     = db.StringProperty(required=True,
+                                 choices=set(['update', 'notify']))
+    created  = db.DateTimeProperty(auto_now_add=True)
+    units    = db.IntegerProperty(default=0)
+    finished = db.DateTimeProperty()
+    # For notify jobs, the last ChangeEvent the job covers.
+    sequence = db.IntegerProperty()
+    # For update jobs, the plan made when the job started, which is
+    # completed with the units' counts once they are all done.
+    run      = db.ReferenceProperty(RefreshRun)
+
+    @classmethod
+    def key_name_for(cls, kind, day):
+        return '%s-%s' % (kind, day.strftime('%Y%m%d'))
+
+class JobUnit(db.Model):
+    """
+    One unit of a Job: a zipcode for an update job, or a shard of
+    users for a notify job.  Units are root entities so that runners
+    claiming different units don't contend.
+    """
+    job      = db.ReferenceProperty(Job, required=True)
+    zipcode  = db.IntegerProperty()
+    users    = db.ListProperty(db.Key)
+    done     = db.BooleanProperty(default=False)
+    failed   = db.BooleanProperty(default=False)
+    attempts = db.IntegerProperty(default=0)
+    leased_until = db.DateTimeProperty()
+    # What an update unit's refresh did, for the job's RefreshRun.
+    requests        = db.IntegerProperty(default=0)
+    request_seconds = db.FloatProperty(default=0.0)
+    restaurants     = db.IntegerProperty(default=0)
+    zipcodes_skipped   = db.IntegerProperty(default=0)
+    zipcodes_processed = db.IntegerProperty(default=0)
+    zipcodes_failed    = db.IntegerProperty(default=0)
+
+    def claim(self, lease=JOB_LEASE):
+        """
+        Take the unit for lease, unless it is done or someone else has
+        it.  Returns the claimed unit, or None.
+        """
+        def txn():
+            unit = db.get(self.key())
+            now = datetime.now()
+            if unit.done or (unit.leased_until and unit.leased_until > now):
+                return None
+            unit.attempts += 1
+            unit.leased_until = now + lease
+            unit.put()
+            return unit
+        return db.run_in_transaction(txn)
+
+    def finish(self, failed=False):
+        self.done = True
+        self.failed = failed
+        self.leased_until = None
+        self.put()
+
+def pending_units(job_key):
+    return (JobUnit.all().filter('job =', job_key)
+            .filter('done =', False))
+
+# The counts a unit keeps of its part of a job's RefreshRun.
+UNIT_RUN_COUNTS = ('requests', 'request_seconds', 'restaurants',
+                   'zipcodes_skipped', 'zipcodes_processed',
+                   'zipcodes_failed')
+
+def run_update_unit(job, unit, transport=None):
+    """
+    Refresh one zipcode as the job planned: from the DoH site, or from
+    the snapshot saved when the job downloaded the whole city.  Raises
+    DohError if the zipcode couldn't be fetched, or SnapshotMissing if
+    that snapshot can't be loaded, so that the unit is retried.
+    """
+    updates = None
+    if job.run.strategy == 'citywide':
+        snapshot = snapshot_store.load(job.run.snapshot)
+        updates = snapshot.index.search(zipcode=unit.zipcode)[1]
+    restaurants = list(Restaurant.all().filter('zipcode =', unit.zipcode))
+    run = RefreshRun(strategy='bulk' if updates is not None else 'zipcode')
+    # Units run in parallel, so their events are staged under the unit
+    # and numbered by finish_update_job.
+    UpdateRestaurantPage().update_restaurants(
+        restaurants, updates=updates, run=run,
+        record_events=functools.partial(stage_events, unit.key()))
+    for name in UNIT_RUN_COUNTS:
+        setattr(unit, name, getattr(run, name))
+    if run.zipcodes_failed:
+        raise DohError('zipcode %s: fetch failed' % unit.zipcode)
+
+def run_notify_unit(job, unit, transport=None):
+    notify_users([user for user in db.get(unit.users) if user is not None],
+                 transport)
+
+def finish_update_job(job):
+    """
+    Number the events the units staged, total the units' counts into
+    the job's RefreshRun, and patch the citywide stats with the
+    restaurants the job changed, once for the whole job.
+    """
+    run = job.run or RefreshRun(strategy='zipcode', zipcodes=job.units)
+    for name in UNIT_RUN_COUNTS:
+        setattr(run, name, 0)
+    for unit in JobUnit.all().filter('job =', job.key()):
+        put_staged_events(unit.key())
+        for name in UNIT_RUN_COUNTS:
+            setattr(run, name, getattr(run, name) + getattr(unit, name))
+    run.seconds = (job.finished - job.created).total_seconds()
+    run.put()
+    changed = Restaurant.all().filter('last_updated >=', job.created)
+    citywide_store.apply([restaurant.record() for restaurant in changed])
+
+JOB_UNIT_RUNNERS = {'update': run_update_unit,
+                    'notify': run_notify_unit}
+
+def finish_job(job_key):
+    """
+    Mark a job finished once none of its units are left.  Finishing a
+    notify job moves NotifyState past the events it covered.
+    """
+    if pending_units(job_key).get() is not None:
+        return False
+    def txn():
+        job = db.get(job_key)
+        if job.finished is not None:
+            return False
+        job.finished = datetime.now()
+        job.put()
+        return True
+    if not db.run_in_transaction(txn):
+        return True
+    job = db.get(job_key)
+    if job.kind == 'update':
+        finish_update_job(job)
+    if job.kind == 'notify':
+        state = NotifyState.get_or_insert(NotifyState.KEY_NAME)
+        if job.sequence > state.sequence:
+            state.sequence = job.sequence
+            state.put()
+    logging.info('job %s finished', job_key.name())
+    return True
+
+def defer_job(job_key, cursor=None, countdown=0):
+    deferred.defer(run_job_task, str(job_key), cursor, _countdown=countdown)
+
+def run_job_task(job_key, cursor=None):
+    JobRunner().run(db.Key(job_key), cursor)
+
+class JobRunner(object):
+    """
+    Works through the pending units of a job for up to budget
+    seconds.  schedule(job_key, cursor, countdown) arranges for run()
+    to be called again later.  Notify units send mail with transport.
+    """
+    def __init__(self, budget=JOB_REQUEST_SECONDS, lease=JOB_LEASE,
+                 schedule=None, clock=time.time, transport=None):
+        self.budget    = budget
+        self.lease     = lease
+        self.schedule  = schedule or defer_job
+        self.clock     = clock
+        self.transport = transport
+
+    def run_unit(self, job, unit):
+        JOB_UNIT_RUNNERS[job.kind](job, unit, self.transport)
+
+    def run(self, job_key, cursor=None):
+        """
+        Returns True if the job is finished.
+        """
+        start = self.clock()
+        job = db.get(job_key)
+        if job is None or job.finished is not None:
+            return True
+        while True:
+            query = pending_units(job_key)
+            if cursor:
+                query.with_cursor(cursor)
+            units = query.fetch(JOB_PAGE_SIZE)
+            if not units:
+                break
+            for unit in units:
+                if self.clock() - start > self.budget:
+                    # Carry on from the start of this page; the units
+                    # done since have dropped out of the query.
+                    self.schedule(job_key, cursor, 0)
+                    return False
+                unit = unit.claim(self.lease)
+                if unit is None:
+                    continue
+                try:
+                    self.run_unit(job, unit)
+                except Exception:
+                    logging.exception('job %s: unit %s failed',
+                                      job_key.name(), unit.key().name())
+                    if unit.attempts >= JOB_MAX_ATTEMPTS:
+                        unit.finish(failed=True)
+                    continue
+                unit.finish()
+            cursor = query.cursor()
+        if finish_job(job_key):
+            return True
+        # Other runners hold the rest, or they failed; look again once
+        # their leases could have run out.
+        self.schedule(job_key, None, int(self.lease.total_seconds()))
+        return False
+
+def start_job(kind, make_units, sequence=None, runners=JOB_RUNNERS,
+              schedule=None, day=None):
+    """
+    Create today's job of kind and start runners on it.
+    make_units(job) returns a dict of unit name to JobUnit properties,
+    and may set properties of the job.  If today's job already exists,
+    it is resumed instead.  Returns the job.
+    """
+    schedule = schedule or defer_job
+    key_name = Job.key_name_for(kind, day or date.today())
+    job = Job.get_or_insert(key_name, kind=kind, sequence=sequence)
+    if job.finished is not None:
+        return job
+    if not job.units:
+        units = make_units(job)
+        put_in_batches([JobUnit(key_name='%s:%s' % (key_name, name),
+                                job=job, **props)
+                        for name, props in units.items()])
+        job.units = len(units)
+        job.put()
+    for i in range(runners):
+        schedule(job.key(), None, 0)
+    return job
 
-# -------------------------------------------------------------------
-# Data models
-#
+def start_update_job(schedule=None, batch_size=DATASTORE_BATCH_SIZE):
+    """
+    Start today's update job, with a unit per zipcode of a subscribed
+    restaurant.  FetchPlanner plans the whole job up front; if it
+    picks a citywide download, that is done here, once, and the units
+    reconcile against the new snapshot.
+    """
+    def make_units(job):
+        used = prune_restaurants(batch_size)
+        restaurants = get_in_batches(
+            [Restaurant.make_key(camis) for camis in used], batch_size)
+        zipcodes = set(r.zipcode for r in restaurants if r is not None)
+        planner = FetchPlanner.from_history()
+        run = planner.plan(len(zipcodes))
+        logging.info('update job: %d zipcodes by %s: estimated %.1fs by '
+                     'zipcode, %.1fs citywide', run.zipcodes, run.strategy,
+                     run.estimated_zipcode_seconds,
+                     run.estimated_citywide_seconds)
+        if run.strategy == 'citywide':
+            try:
+                snapshot = snapshot_store.save(fetch_citywide(
+                    planner.citywide_restaurants))
+                run.snapshot = snapshot.fetched
+                citywide_store.rebuild(snapshot)
+            except Exception as e:
+                logging.error('citywide fetch failed, '
+                              'falling back to zipcodes: %s', e)
+                run.strategy = 'zipcode'
+        run.put()
+        job.run = run
+        return dict((str(z), {'zipcode': z}) for z in zipcodes)
+    return start_job('update', make_units, schedule=schedule)
 
-class Restaurant(db.Model):
+def start_notify_job(schedule=None, shard_size=NOTIFY_SHARD_SIZE):
     """
-    Models a subscription to a particular restaurant.
+    Start today's notify job, with a unit per shard of the users
+    affected by ChangeEvents since the last notify run.
     """
-    name     = db.StringProperty()
-    zipcode  = db.IntegerProperty()
-    street   = db.StringProperty()
-    cuisine  = db.StringProperty()
-    grade    = db.StringProperty()
-    score    = db.IntegerProperty()
-    last_inspected = db.DateProperty()
-    prev_grade     = db.StringProperty()
-    prev_score     = db.IntegerProperty()
-    prev_inspected = db.DateProperty()
-    last_updated   = db.DateTimeProperty()
+    state = NotifyState.get_or_insert(NotifyState.KEY_NAME)
+    def make_units(job):
+        users = affected_users(list(events_after(state.sequence)))
+        return dict((str(i), {'users': shard})
+                    for i, shard in enumerate(batches(users, shard_size)))
+    return start_job('notify', make_units, sequence=current_sequence(),
+                     schedule=schedule)
 
-    @classmethod
-    def make_key(cls, camis):
-        """
-        Constructs a Datastore key for a restaurant.
-        """
-        return db.Key.from_path('Restaurant', camis)
+class SimulatedDeadline(BaseException):
+    """
+    Raised by LocalJobRunner to act out a request running out of time.
+    Like App Engine's DeadlineExceededError, it isn't an Exception, so
+    it isn't caught as a unit failing.
+    """
 
-class User(db.Model):
-    last_notified = db.DateTimeProperty()
-    email = db.StringProperty()
+class RecordingTransport(object):
+    """
+    Passes messages on to another transport, and keeps who each went
+    to and what it said.
+    """
+    def __init__(self, transport=None):
+        self.transport = transport or mail_transport
+        self.lock      = threading.Lock()
+        self.sent      = []
 
-    @classmethod
-    def make_key(cls, user_id):
-        """
-        Construct a User key from a user id
-        """
-        return db.Key.from_path('User', user_id)
+    def send(self, sender, to, subject, body, html):
+        self.transport.send(sender, to, subject, body, html)
+        with self.lock:
+            self.sent.append((to, body))
 
-class Subscription(db.Model):
-    NOTIFY_CHOICES=["email", "sms", "none"]
-    restaurant = db.ReferenceProperty(Restaurant,
-                                      required=True)
-    notify_grade_change = db.StringProperty(
-        required=True,
-        choices=set(NOTIFY_CHOICES))
-    notify_score_change = db.StringProperty(
-        required=True,
-        choices=set(NOTIFY_CHOICES))
-    notify_inspection_change = db.StringProperty(
-        required=True,
-        choices=set(NOTIFY_CHOICES))    
+class LocalJobRunner(JobRunner):
+    """
+    Runs jobs to the end in this process, for testing.  Tasks are kept
+    in a list rather than the task queue, and leases are not waited
+    for.  With probability kill_rate a unit is killed, half the time
+    before its work and half the time after it, once its mail has gone
+    but before it is marked done, and its task is retried as the task
+    queue would.  Mail is recorded, and run_all checks that no message
+    was sent twice.
+    """
+    def __init__(self, kill_rate=0.0, seed=None, transport=None, **kwargs):
+        kwargs.setdefault('lease', timedelta(0))
+        JobRunner.__init__(self, schedule=self.push,
+                           transport=RecordingTransport(transport), **kwargs)
+        self.kill_rate = kill_rate
+        self.random    = random.Random(seed)
+        self.tasks     = []
+        self.runs      = 0
+        self.kills     = 0
 
-    @classmethod
-    def make_key(cls, user_id, camis):
+    def push(self, job_key, cursor=None, countdown=0):
+        self.tasks.append((job_key, cursor))
+
+    def run_unit(self, job, unit):
+        if self.random.random() < self.kill_rate / 2:
+            raise SimulatedDeadline()
+        JobRunner.run_unit(self, job, unit)
+        if self.random.random() < self.kill_rate / 2:
+            raise SimulatedDeadline()
+
+    def run_all(self):
         """
-        Construct a Subscription key from a user id and a restaurant
-        id
+        Run tasks until there are none left.
         """
-        return db.Key.from_path('User', user_id, 'Subscription', camis)
+        while self.tasks:
+            job_key, cursor = self.tasks.pop(0)
+            self.runs += 1
+            try:
+                self.run(job_key, cursor)
+            except SimulatedDeadline:
+                self.kills += 1
+                self.push(job_key, cursor)
+        logging.info('local jobs: %d runs, %d killed', self.runs, self.kills)
+        sent = self.transport.sent
+        if len(set(sent)) != len(sent):
+            raise AssertionError('%d messages sent more than once' %
+                                 (len(sent) - len(set(sent))))
 
-    @classmethod
-    def color(cls, value):
-        if value == 'none':
-            return 'red'
-        else:
-            return 'green'
+def start_job_request(handler, start):
+    """
+    Start a job from a request.  With runner=local, run it here with a
+    LocalJobRunner, killing units at the rate given by kill_rate.
+    """
+    if handler.request.get('runner') != 'local':
+        return start()
+    runner = LocalJobRunner(
+        kill_rate=float(handler.request.get('kill_rate') or 0))
+    job = start(schedule=runner.push)
+    runner.run_all()
+    return job
 
-    @classmethod
-    def text(cls, value):
-        if value == 'none':
-            return 'OFF'
-        else:
-            return 'ON'
+# -------------------------------------------------------------------
+# Page cache
+#
+# Rendered pages are cached under a key made from the endpoint, the
+# query, and version numbers that are bumped whenever what the page
+# shows may have changed: one per user for their subscriptions, and
+# one for all restaurants.
+#
 
-    @property
-    def grade_change_color(self):
-        return self.color(self.notify_grade_change)
+# Seconds a cached page is kept.
+PAGE_CACHE_TTL = 10 * 60
+RESTAURANTS_VERSION = 'version:restaurants'
+CITYWIDE_VERSION = 'version:citywide'
+SNAPSHOT_VERSION = 'version:snapshot'
 
-    @property
-    def grade_change_button(self):
-        return self.text(self.notify_grade_change)
+class MemcachePageBackend(object):
+    def get(self, key):
+        return memcache.get(key)
 
-    @property
-    def score_change_color(self):
-        return self.color(self.notify_score_change)
+    def set(self, key, value, ttl):
+        memcache.set(key, value, time=ttl or 0)
 
-    @property
-    def score_change_button(self):
-        return self.text(self.notify_score_change)
+    def incr(self, key, initial_value):
+        memcache.incr(key, initial_value=initial_value)
 
-    @property
-    def inspection_change_color(self):
-        return self.color(self.notify_inspection_change)
+class LruPageBackend(object):
+    """
+    Keeps up to size entries in instance memory, dropping the least
+    recently used.  For tests and the dev server.
+    """
+    def __init__(self, size=1000):
+        self.size    = size
+        self.entries = OrderedDict()
+        self.lock    = threading.Lock()
 
-    @property
-    def inspection_change_button(self):
-        return self.text(self.notify_inspection_change)
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return None
+            self.entries[key] = entry
+            return value
 
-    def needs_change_text(self, value):
-        if value:
-            return 'YES'
-        else:
-            return 'no'
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value,
+                                 None if ttl is None else time.time() + ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
-    def needs_notify(self, field, prev_field, should_notify):
-        """
-        When a new restaurant is added, it is added with
-        current grade == prev grade, so that we don't send
-        notifications.
+    def incr(self, key, initial_value):
+        self.set(key, (self.get(key) or initial_value) + 1)
 
-        Once something about the restaurant changes, the current value
-        of the field will change, and the last_updated value will be
-        updated and be more recent than the user's last notified
-        field.
+class PageCache(object):
+    def __init__(self, backend, ttl=PAGE_CACHE_TTL):
+        self.backend = backend
+        self.ttl     = ttl
+
+    @staticmethod
+    def new_version():
         """
-        return ((self.parent().last_notified is None or
-                 self.parent().last_notified < self.restaurant.last_updated)
-                and should_notify != 'none'
-                and field != prev_field)
+        A starting point for a version number.  If a version is
+        evicted, it restarts from here rather than from a number that
+        old pages may have been cached under.
+        """
+        return int(time.time() * 1000)
 
-    def needs_grade_notify(self):
-        return self.needs_notify(self.restaurant.grade,
-                                 self.restaurant.prev_grade,
-                                 self.notify_grade_change)
+    def version(self, name):
+        version = self.backend.get(name)
+        if version is None:
+            version = self.new_version()
+            self.backend.set(name, version, None)
+        return version
 
-    def grade_notify_text(self):
-        return self.needs_change_text(self.needs_grade_notify())
+    def user_version(self, user_id):
+        return self.version('version:user:%s' % user_id)
 
-    def needs_score_notify(self):
-        return self.needs_notify(self.restaurant.score,
-                                 self.restaurant.prev_score,
-                                 self.notify_score_change)
+    def invalidate_user(self, user_id):
+        """
+        Call when a user's subscriptions change.
+        """
+        self.backend.incr('version:user:%s' % user_id, self.new_version())
 
-    def score_notify_text(self):
-        return self.needs_change_text(self.needs_score_notify())
+    def invalidate_restaurants(self):
+        """
+        Call when any stored restaurant changes.
+        """
+        self.backend.incr(RESTAURANTS_VERSION, self.new_version())
 
-    def needs_inspection_notify(self):
-        return self.needs_notify(self.restaurant.last_inspected,
-                                 self.restaurant.prev_inspected,
-                                 self.notify_inspection_change)
+    def invalidate_citywide(self):
+        """
+        Call when the citywide stats change.
+        """
+        self.backend.incr(CITYWIDE_VERSION, self.new_version())
 
-    def inspection_notify_text(self):
-        return self.needs_change_text(self.needs_inspection_notify())
+    def invalidate_snapshot(self):
+        """
+        Call when a new snapshot is saved.
+        """
+        self.backend.incr(SNAPSHOT_VERSION, self.new_version())
+
+    def render(self, endpoint, key_parts, render):
+        """
+        The page for endpoint identified by key_parts, from the cache
+        or else from render().
+        """
+        key = 'page:%s:%s' % (endpoint,
+                              hashlib.sha1(repr(key_parts)).hexdigest())
+        page = self.backend.get(key)
+        if page is None:
+            stats.count('page_cache.miss')
+            page = render()
+            self.backend.set(key, page, self.ttl)
+        else:
+            stats.count('page_cache.hit')
+        return page
+
+page_cache = PageCache(MemcachePageBackend())
 
 # -------------------------------------------------------------------
 # Pages
 #
 
+# Number of search results shown per page on /find.
+FIND_PAGE_SIZE = 100
+
+def render_template(name, values):
+    with stats.span('render.' + name):
+        return jinja_environment.get_template(name).render(values)
+
 class HomePage(webapp2.RequestHandler):
     def update_user(self, user):
         user_obj = db.get(User.make_key(user.user_id()))
         if (user_obj and user_obj.email != user.email()):
             user_obj.email = user.email()
             user_obj.put()
-            
+        return user_obj
+
     def get(self):
         user = gusers.get_current_user()
         if not user:
             self.redirect('/')
 
-        self.update_user(user)
+        user_obj = self.update_user(user)
+        sort_key = self.request.get('sort')
+        # Counts from a bulk subscribe that redirected here.
+        imported = None
+        if 'added' in self.request.GET:
+            imported = {
+                'added': self.request.get_range('added', min_value=0),
+                'missing': self.request.get_range('missing', min_value=0),
+                'skipped': self.request.get_range('skipped', min_value=0),
+                'limit': BULK_SUBSCRIBE_MAX}
+        self.response.out.write(page_cache.render(
+            'home',
+            (user.user_id(), sort_key,
+             page_cache.user_version(user.user_id()),
+             page_cache.version(RESTAURANTS_VERSION),
+             imported and sorted(imported.items())),
+            lambda: self.render(user, user_obj, sort_key, imported)))
 
-        subscriptions = Subscription.all().ancestor(
-            User.make_key(user.user_id()))
+    def render(self, user, user_obj, sort_key, imported=None):
+        # One batch, so that the query takes as many RPCs for a user
+        # with hundreds of subscriptions as for one with a few.
+        subscriptions = prefetch_subscriptions(
+            Subscription.all().ancestor(User.make_key(user.user_id()))
+            .run(batch_size=DATASTORE_BATCH_SIZE),
+            user_obj)
 
-        sort_key = self.request.get('sort')
         if sort_key == 'last_inspected':
             subscriptions = sorted(subscriptions, key=lambda s: s.restaurant.last_inspected)
         elif sort_key == 'score':
@@ -302,11 +3754,11 @@ class HomePage(webapp2.RequestHandler):
             # by default, sort by name
             subscriptions = sorted(subscriptions, key=lambda s: s.restaurant.name)
 
-        template = jinja_environment.get_template('home.html')
-        self.response.out.write(template.render({
+        return render_template('home.html', {
             'subscriptions': subscriptions,
+            'imported': imported,
             'logout_url': gusers.create_logout_url('/')
-            }))
+            })
 
 class FindPage(webapp2.RequestHandler):
     def get(self):
@@ -314,34 +3766,188 @@ class FindPage(webapp2.RequestHandler):
         if not user:
             self.redirect('/')
 
-        subscriptions = Subscription.all(keys_only=True).ancestor(
-            User.make_key(user.user_id()))
-        ids = [k.id_or_name() for k in subscriptions]
-
         name    = self.request.get('name')
-        zipcode = self.request.get('zipcode')
-        restaurants = find_restaurants(name, zipcode)
+        zipcode = self.request.get('zipcode').strip()
+        sort    = self.request.get('sort') or 'name'
+        offset  = self.request.get_range('offset', min_value=0)
+        if parse_zipcode(zipcode) is None:
+            zipcode = ''
+        self.response.out.write(page_cache.render(
+            'find',
+            (user.user_id(), name.strip().upper(), zipcode, sort,
+             offset, page_cache.user_version(user.user_id()),
+             snapshot_store.get().fetched),
+            lambda: self.render(user, name, zipcode, sort, offset)))
 
-        sort_key = self.request.get('sort')
-        if sort_key is None:
-            # by default, sort by name
-            sort_key = 'name'
-        if len(restaurants) > 1 and sort_key in restaurants[0]:
-            restaurants = sorted(restaurants, key=lambda r: r[sort_key])
+    def render(self, user, name, zipcode, sort, offset):
+        subscriptions = Subscription.all(keys_only=True).ancestor(
+            User.make_key(user.user_id()))
+        subscribed = set(k.id_or_name() for k in subscriptions)
 
-        for restaurant in restaurants:
-            if restaurant['camis'] in ids:
-                restaurant['action'] = "Remove"
-            else:
-                restaurant['action'] = "Add"
+        total, restaurants = search_restaurants(name, zipcode, sort,
+                                                offset, FIND_PAGE_SIZE)
 
-        template = jinja_environment.get_template('find.html')
-        self.response.out.write(template.render({
+        # urlencode only takes byte strings.
+        name = name.encode('utf-8')
+        sort = sort.encode('utf-8')
+        query = {'name': name, 'zipcode': zipcode, 'sort': sort}
+        return render_template('find.html', {
             'restaurants': restaurants,
+            'subscribed': subscribed,
+            'total': total,
+            'offset': offset,
+            'page_size': FIND_PAGE_SIZE,
+            'page_end': min(offset + FIND_PAGE_SIZE, total),
+            'prev_offset': max(offset - FIND_PAGE_SIZE, 0),
+            'query': urllib.urlencode(query),
+            'search': urllib.urlencode({'name': name, 'zipcode': zipcode}),
             'logout_url': gusers.create_logout_url('/')
-            }))
+            })
+
+# Most restaurants one bulk subscribe may add.
+BULK_SUBSCRIBE_MAX = DATASTORE_BATCH_SIZE
+
+# Camis are all digits, like zipcodes.
+CAMIS_PATTERN = ZIPCODE_PATTERN
+
+# Excel starts the CSV files it saves as UTF-8 with a byte order mark.
+UTF8_BOM = '\xef\xbb\xbf'
+
+def resolve_restaurants(camis_list, zipcodes=None):
+    """
+    The Restaurants for camis_list, as a dict by camis, and the new
+    unsaved ones among them.  Restaurants we don't store are copied
+    from the snapshot, or else fetched from the DoH site with one
+    request per zipcode, for the camis that zipcodes gives a zipcode
+    for.  Camis that can't be found are left out.
+    """
+    zipcodes = zipcodes or {}
+    restaurants = {}
+    missing = []
+    for camis, restaurant in zip(camis_list, get_in_batches(
+        [Restaurant.make_key(camis) for camis in camis_list])):
+        if restaurant is None:
+            missing.append(camis)
+        else:
+            restaurants[camis] = restaurant
+    records = {}
+    if missing:
+        index = snapshot_store.get().index
+        for camis in missing:
+            record = index.get(camis)
+            if record is not None:
+                records[camis] = record
+    unresolved = set(camis for camis in missing
+                     if camis not in records and zipcodes.get(camis))
+    for zipcode, fetched, error in fetch_zipcodes(
+        sorted(set(zipcodes[camis] for camis in unresolved))):
+        if error is not None:
+            logging.error('zipcode %s: giving up: %s', zipcode, error)
+            continue
+        for record in fetched:
+            if record.camis in unresolved:
+                records[record.camis] = record
+    new = [Restaurant.from_record(record) for record in records.values()]
+    restaurants.update((r.key().name(), r) for r in new)
+    return restaurants, new
+
+def bulk_subscribe(user, camis_list, zipcodes=None):
+    """
+    Subscribe a signed-in user to every restaurant in camis_list that
+    they don't already subscribe to.  zipcodes optionally maps camis
+    to zipcode, for restaurants too new for the snapshot.  Returns the
+    number of subscriptions added and the camis that couldn't be
+    found.
+    """
+    user_id = user.user_id()
+    user_ent = db.get(User.make_key(user_id))
+    if user_ent is None:
+        user_ent = User(key_name=user_id,
+                        email=user.email(),
+                        last_notified=datetime.now(),
+                        event_cursor=current_sequence())
+    existing = db.get([Subscription.make_key(user_id, camis)
+                       for camis in camis_list])
+    camis_list = [camis for camis, sub in zip(camis_list, existing)
+                  if sub is None]
+    restaurants, new = resolve_restaurants(camis_list, zipcodes)
+    put_in_batches(new)
+    subscriptions = [Subscription(key_name=camis,
+                                  restaurant=restaurants[camis],
+                                  notify_score_change='email',
+                                  notify_grade_change='email',
+                                  notify_inspection_change='email',
+                                  parent=user_ent)
+                     for camis in camis_list if camis in restaurants]
+    subscribe_all(user_ent, subscriptions)
+    return (len(subscriptions),
+            [camis for camis in camis_list if camis not in restaurants])
+
+def read_camis_csv(stream):
+    """
+    Read camis, and zipcodes where given, from an uploaded CSV file.
+    The file either has a header row naming CAMIS and ZIPCODE columns,
+    or has camis in its first column and zipcodes in its second.
+    Returns a list of camis and a dict of camis to zipcode, and the
+    number of rows whose camis isn't a number.
+    """
+    lines = iter_lines(stream)
+    first = next(lines, '')
+    if first.startswith(UTF8_BOM):
+        first = first[len(UTF8_BOM):]
+    rows = list(csv.reader(itertools.chain([first], lines)))
+    camis_column, zipcode_column = 0, 1
+    if rows and 'CAMIS' in [name.strip().upper() for name in rows[0]]:
+        header = [name.strip().upper() for name in rows.pop(0)]
+        camis_column = header.index('CAMIS')
+        zipcode_column = (header.index('ZIPCODE') if 'ZIPCODE' in header
+                          else None)
+    camis_list = []
+    zipcodes = {}
+    invalid = 0
+    for row in rows:
+        if len(row) <= camis_column or not row[camis_column].strip():
+            continue
+        camis = row[camis_column].strip()
+        if not CAMIS_PATTERN.match(camis):
+            invalid += 1
+            continue
+        camis_list.append(camis)
+        if (zipcode_column is not None and len(row) > zipcode_column and
+            row[zipcode_column].strip().isdigit()):
+            zipcodes[camis] = int(row[zipcode_column])
+    return camis_list, zipcodes, invalid
 
 class UpdateSubscriptionPage(webapp2.RequestHandler):
+    def bulk_add(self, user):
+        """
+        Subscribe user to the camis typed in and uploaded.  Returns the
+        number of subscriptions added, the number of camis that weren't
+        numbers or couldn't be found, and the number left out for being
+        past BULK_SUBSCRIBE_MAX.
+        """
+        typed = [camis for camis in re.split(r'[\s,]+',
+                                             self.request.get('camis').strip())
+                 if camis]
+        camis_list = [camis for camis in typed if CAMIS_PATTERN.match(camis)]
+        invalid = len(typed) - len(camis_list)
+        zipcodes = {}
+        upload = self.request.POST.get('file')
+        if getattr(upload, 'file', None) is not None:
+            uploaded, zipcodes, bad_rows = read_camis_csv(upload.file)
+            camis_list.extend(uploaded)
+            invalid += bad_rows
+        seen = set()
+        camis_list = [camis for camis in camis_list
+                      if not (camis in seen or seen.add(camis))]
+        skipped = max(len(camis_list) - BULK_SUBSCRIBE_MAX, 0)
+        added, unresolved = bulk_subscribe(
+            user, camis_list[:BULK_SUBSCRIBE_MAX], zipcodes)
+        logging.info('%s: added %d subscriptions, %d not found: %s, '
+                     '%d invalid, %d over the limit', user.user_id(), added,
+                     len(unresolved), ', '.join(unresolved), invalid, skipped)
+        return added, len(unresolved) + invalid, skipped
+
     def post(self):
         user = gusers.get_current_user()
         if not user:
@@ -352,12 +3958,24 @@ class UpdateSubscriptionPage(webapp2.RequestHandler):
             user_obj = db.get(User.make_key(user.user_id()))
             if user_obj is not None:
                 user_obj.delete()
-            subscriptions = Subscription.all().ancestor(User.make_key(user.user_id()))
-            for sub in subscriptions:
-                sub.delete()
+            subscriptions = Subscription.all(keys_only=True).ancestor(
+                User.make_key(user.user_id()))
+            for key in subscriptions:
+                unsubscribe(key)
+            page_cache.invalidate_user(user.user_id())
             self.redirect('/home')
             return
 
+        if action == 'BulkAdd':
+            added, missing, skipped = self.bulk_add(user)
+            page_cache.invalidate_user(user.user_id())
+            goto = self.request.get('goto') or '/home'
+            self.redirect('%s%s%s' % (
+                goto, '&' if '?' in goto else '?',
+                urllib.urlencode({'added': added, 'missing': missing,
+                                  'skipped': skipped})))
+            return
+
         camis  = self.request.get('camis')
         goto   = self.request.get('goto')
         key = Subscription.make_key(user.user_id(), camis)
@@ -368,31 +3986,22 @@ class UpdateSubscriptionPage(webapp2.RequestHandler):
                 if restaurant is None:
                     name    = self.request.get('name')
                     zipcode = self.request.get('zipcode')
-                    restaurants = find_restaurants(name, zipcode)
-                    matches = [r for r in restaurants
-                               if r['camis'] == camis]
-                    if len(matches) == 1:
-                        restaurant = Restaurant(
-                            key_name=camis
-                            ,name=matches[0]['name']
-                            ,zipcode=matches[0]['zipcode']
-                            ,street=matches[0]['street']
-                            ,cuisine=matches[0]['cuisine']
-                            ,grade=matches[0]['grade']
-                            ,score=matches[0]['score']
-                            ,last_inspected=matches[0]['last_inspected']
-                            ,prev_grade=matches[0]['grade']
-                            ,prev_score=matches[0]['score']
-                            ,prev_inspected=matches[0]['last_inspected']
-                            )
-                        restaurant.last_updated = datetime.now()
+                    match = snapshot_store.get().index.get(camis)
+                    if match is None:
+                        # Too new for the snapshot, ask the DoH site.
+                        restaurants = fetch_restaurants(name, zipcode)
+                        match = dict((r.camis, r)
+                                     for r in restaurants).get(camis)
+                    if match is not None:
+                        restaurant = Restaurant.from_record(match)
                         restaurant.put()
                 if restaurant != None:
                     user_ent = db.get(User.make_key(user.user_id()))
                     if user_ent is None:
                         user_ent = User(key_name=user.user_id(),
                                         email=user.email(),
-                                        last_notified=datetime.now())
+                                        last_notified=datetime.now(),
+                                        event_cursor=current_sequence())
                         user_ent.put()
                     subscription = Subscription(
                         key_name=camis,
@@ -401,10 +4010,10 @@ class UpdateSubscriptionPage(webapp2.RequestHandler):
                         notify_grade_change='email',
                         notify_inspection_change='email',
                         parent=user_ent)
-                    subscription.put()
+                    subscribe(subscription)
         elif action == 'Remove':
             if subscription is not None:
-                subscription.delete()
+                unsubscribe(subscription.key())
         elif action == 'Change':
             if subscription is not None:
                 field = self.request.get('field')
@@ -428,6 +4037,7 @@ class UpdateSubscriptionPage(webapp2.RequestHandler):
                     changed = False
                 if changed:
                     subscription.put()
+        page_cache.invalidate_user(user.user_id())
         self.redirect(goto)
 
 class UpdateRestaurantPage(webapp2.RequestHandler):
@@ -438,36 +4048,180 @@ class UpdateRestaurantPage(webapp2.RequestHandler):
         return by_zipcode
 
     def update_one_restaurant(self, restaurant, update):
-        changed = False
-        if (restaurant.grade != update['grade'] or
-            restaurant.score != update['score'] or
-            restaurant.last_inspected != update['last_inspected']):
-            changed = True
-        if changed:
+        """
+        Copy a changed update onto restaurant.  Returns the unsaved
+        ChangeEvents describing what changed; the caller is
+        responsible for putting them and the restaurant.
+        """
+        events = []
+        if restaurant_changed(restaurant, update):
+            now = datetime.now()
+            events = change_events(restaurant, update, now)
             restaurant.prev_score = restaurant.score
             restaurant.prev_grade = restaurant.grade
             restaurant.prev_inspected = restaurant.last_inspected
             for fld in ('name', 'zipcode', 'street', 'cuisine',
                         'grade', 'score', 'last_inspected'):
-                setattr(restaurant, fld, update[fld])
-            restaurant.last_updated = datetime.now()
-            restaurant.put()
+                setattr(restaurant, fld, getattr(update, fld))
+            restaurant.last_updated = now
+        return events
+
+    def fetch_updates(self, run, zipcodes, fetch, expected, updates=None):
+        """
+        Download the restaurants in zipcodes using run.strategy;
+        expected is how many restaurants a citywide download should
+        return.  Yields (zipcode, restaurants, error) like
+        fetch_zipcodes.  A citywide download also refreshes the search
+        snapshot.  If it fails, we fall back to fetching by zipcode.
+        The 'bulk' strategy downloads nothing, and hands out updates
+        instead.
+        """
+        if run.strategy == 'bulk':
+            by_zipcode = self.group_restaurants(updates)
+            for zipcode in zipcodes:
+                yield zipcode, by_zipcode.get(zipcode, []), None
+            return
+        if run.strategy == 'citywide':
+            try:
+                restaurants = fetch_citywide(expected, fetch=fetch)
+            except Exception as e:
+                logging.error('citywide fetch failed, '
+                              'falling back to zipcodes: %s', e)
+                run.strategy = 'zipcode'
+            else:
+                citywide_store.rebuild(snapshot_store.save(restaurants))
+                by_zipcode = self.group_restaurants(restaurants)
+                for zipcode in zipcodes:
+                    yield zipcode, by_zipcode.get(zipcode, []), None
+                return
+        for result in fetch_zipcodes(zipcodes, fetch=fetch):
+            yield result
+
+    @stats.timed('update_restaurants')
+    def update_restaurants(self, restaurants,
+                           batch_size=DATASTORE_BATCH_SIZE, updates=None,
+                           run=None, record_events=put_events):
+        """
+        Refresh restaurants from the DoH site.  FetchPlanner decides
+        whether to download them by zipcode or for the whole city.
+        Each zipcode is reconciled as soon as it arrives, and its
+        changes are recorded as ChangeEvents and written with batched
+        puts.  Zipcodes whose ZipcodeDigests show nothing new are
+        skipped.  Returns the reconcile counts for each zipcode that
+        was processed.
+
+        If updates is given, it is a list of RestaurantRecords (say
+        from the open data export) to reconcile against instead of
+        downloading anything.
 
-    def update_restaurants(self, restaurants):
+        If run is given, this is one part of a refresh that has
+        already been planned, such as a unit of an update job:
+        run.strategy ('zipcode' or 'bulk') is used and run's counts are
+        filled in, but saving run and patching the citywide stats are
+        left to the caller.
+
+        record_events(events) records each zipcode's ChangeEvents; by
+        default they are numbered and put as they are found.
+        """
+        start = time.time()
         by_zipcode = self.group_restaurants(restaurants)
-        for zipcode in by_zipcode:
-            updated = find_restaurants(zipcode=zipcode)
-            zipres = by_zipcode[zipcode]
-            for update in updated:
-                matches = [r for r in zipres
-                           if r.key().id_or_name() == update['camis']]
-                if len(matches) == 1:
-                    self.update_one_restaurant(matches[0], update)
+        zipcodes = list(by_zipcode)
+        digests = get_in_batches([ZipcodeDigest.make_key(z) for z in zipcodes],
+                                 batch_size)
+        digests = dict((z, d or ZipcodeDigest(key=ZipcodeDigest.make_key(z)))
+                       for z, d in zip(zipcodes, digests))
+        settled = set(z for z in zipcodes
+                      if digests[z].settled(by_zipcode[z]))
+
+        part = run is not None
+        expected = None
+        if part:
+            run.zipcodes = len(by_zipcode)
+        elif updates is None:
+            planner = FetchPlanner.from_history()
+            run = planner.plan(len(by_zipcode))
+            expected = planner.citywide_restaurants
+            logging.info('refreshing %d zipcodes by %s: estimated %.1fs by '
+                         'zipcode, %.1fs citywide', run.zipcodes, run.strategy,
+                         run.estimated_zipcode_seconds,
+                         run.estimated_citywide_seconds)
+        else:
+            run = RefreshRun(zipcodes=len(by_zipcode), strategy='bulk')
+            logging.info('refreshing %d zipcodes from %d bulk records',
+                         run.zipcodes, len(updates))
+        fetch = ConditionalFetch(dict((z, digests[z].raw) for z in settled))
+        timer = FetchTimer(fetch)
+        counts = {}
+        dirty = []
+        applied = []
+        for zipcode, updated, error in self.fetch_updates(
+            run, zipcodes, timer, expected, updates):
+            if error is not None:
+                logging.error('zipcode %s: giving up: %s', zipcode, error)
+                run.zipcodes_failed += 1
+                continue
+            digest = digests[zipcode]
+            if updated is None:
+                logging.info('zipcode %s: response unchanged', zipcode)
+                run.zipcodes_skipped += 1
+                digest.checked = datetime.now()
+                dirty.append(digest)
+                continue
+            if run.strategy != 'bulk':
+                # Nothing was downloaded for bulk updates, so the last
+                # response's digest still stands.
+                digest.raw = fetch.digests.get(zipcode)
+            records = records_digest(updated)
+            dirty.append(digest)
+            if zipcode in settled and records == digest.records:
+                logging.info('zipcode %s: restaurants unchanged', zipcode)
+                run.zipcodes_skipped += 1
+                digest.checked = datetime.now()
+                continue
+            changed, counts[zipcode] = reconcile(by_zipcode[zipcode], updated)
+            entities = []
+            events = []
+            for restaurant, update in changed:
+                new_events = self.update_one_restaurant(restaurant, update)
+                if new_events:
+                    entities.append(restaurant)
+                    events.extend(new_events)
+                    applied.append(update)
+            # Events go first: if we are cut short in between, the
+            # restaurants still look changed and a rerun rewrites them.
+            record_events(events)
+            put_in_batches(entities, batch_size)
+            if entities:
+                page_cache.invalidate_restaurants()
+            digest.records = records
+            digest.checked = datetime.now()
+            run.zipcodes_processed += 1
+            logging.info('zipcode %s: %s', zipcode, counts[zipcode])
+        put_in_batches(dirty, batch_size)
+        logging.info('%d zipcodes processed, %d skipped, %d failed',
+                     run.zipcodes_processed, run.zipcodes_skipped,
+                     run.zipcodes_failed)
+        run.requests        = timer.requests
+        run.request_seconds = timer.seconds
+        run.restaurants     = timer.restaurants
+        run.seconds         = time.time() - start
+        if not part:
+            citywide_store.apply(applied)
+            run.put()
+        return counts
 
     def get(self):
         action = self.request.get('action')
 
-        if action == 'update':
+        if action == 'snapshot':
+            citywide_store.rebuild(snapshot_store.refresh())
+            self.redirect('/updateres')
+
+        elif action == 'rebuild_index':
+            RestaurantSubscribers.rebuild()
+            self.redirect('/updateres')
+
+        elif action == 'update':
             camis   = self.request.get('camis')
             name    = self.request.get('name')
             zipcode = self.request.get('zipcode')
@@ -476,24 +4230,32 @@ class UpdateRestaurantPage(webapp2.RequestHandler):
             self.redirect('/updateres')
 
         elif action == 'update_all':
-            # make a note of used restaurants
-            used = set()
-            subscriptions = Subscription.all()
-            for sub in subscriptions:
-                used.add(sub.restaurant.key().id_or_name())
+            batch_size = self.request.get_range(
+                'batch_size', min_value=1, max_value=DATASTORE_BATCH_SIZE,
+                default=DATASTORE_BATCH_SIZE)
 
-            # delete any unused restaurants
-            restaurants = Restaurant.all()
-            used_restaurants = []
-            for r in restaurants:
-                if r.key().id_or_name() in used:
-                    used_restaurants.append(r)
-                else:
-                    r.delete()
-            restaurants = used_restaurants
+            used = prune_restaurants(batch_size)
 
             # update restaurants
-            self.update_restaurants(restaurants)
+            restaurants = get_in_batches(
+                [Restaurant.make_key(camis) for camis in used], batch_size)
+            self.update_restaurants([r for r in restaurants if r is not None],
+                                    batch_size)
+            self.redirect('/updateres')
+
+        elif action == 'start_job':
+            start_job_request(self, start_update_job)
+            self.redirect('/updateres')
+
+        elif action == 'update_bulk':
+            source = self.request.get('source') or None
+            try:
+                bulk_export_path(source)
+            except ValueError as e:
+                self.response.set_status(400)
+                self.response.out.write(cgi.escape(str(e)))
+                return
+            queue_bulk_update(source)
             self.redirect('/updateres')
 
         else:
@@ -502,92 +4264,63 @@ class UpdateRestaurantPage(webapp2.RequestHandler):
             # all at the same time, etc.
             restaurants = Restaurant.all()
             restaurants.get()
-            template = jinja_environment.get_template('update.html')
-            self.response.out.write(template.render({
+            self.response.out.write(render_template('update.html', {
                 'restaurants': restaurants,
                 'logout_url': gusers.create_logout_url('/')
                 }))
 
-class NotifyPage(webapp2.RequestHandler):
-    def notify_user(self, user):
-        subscriptions = Subscription.all().ancestor(user.key())
-        all_lines = []
-        all_html_lines = []
-        for sub in subscriptions:
-            if (user.last_notified is not None and
-                user.last_notified > sub.restaurant.last_updated):
-                continue
-            messages = []
-            html = []
-            if (sub.needs_grade_notify()):
-                messages.append('%s changed its grade from %s to %s on %s' %
-                                (sub.restaurant.name,
-                                 sub.restaurant.prev_grade,
-                                 sub.restaurant.grade,
-                                 sub.restaurant.last_updated))
-                html.append('<a href="http://nyc-restaurant-grades.appspot.com/goto?camis=%s">%s</a> changed its grade from %s to %s on %s' %
-                            (sub.restaurant.key().id_or_name(),
-                             sub.restaurant.name,
-                             sub.restaurant.prev_grade,
-                             sub.restaurant.grade,
-                             sub.restaurant.last_updated))
-            if (sub.needs_score_notify()):
-                messages.append('%s changed its score from %s to %s on %s' %
-                                (sub.restaurant.name,
-                                 sub.restaurant.prev_score,
-                                 sub.restaurant.score,
-                                 sub.restaurant.last_updated))
-                html.append('<a href="http://nyc-restaurant-grades.appspot.com/goto?camis=%s">%s</a> changed its score from %s to %s on %s' %
-                            (sub.restaurant.key().id_or_name(),
-                             sub.restaurant.name,
-                             sub.restaurant.prev_score,
-                             sub.restaurant.score,
-                             sub.restaurant.last_updated))
-            if (sub.needs_inspection_notify()):
-                messages.append('%s was inspected on %s' %
-                                (sub.restaurant.name, sub.restaurant.last_inspected))
-                html.append('<a href="http://nyc-restaurant-grades.appspot.com/goto?camis=%s">%s</a> was inspected on %s' %
-                            (sub.restaurant.key().id_or_name(),
-                             sub.restaurant.name,
-                             sub.restaurant.last_inspected))
-            if len(messages) == 0:
-                continue
-            messages.append('')
-            messages.append('http://nyc-restaurant-grades.appspot.com/home')
-            messages.append('http://nyc-restaurant-grades.appspot.com/goto?camis=%s' %
-                            sub.restaurant.key().id_or_name())
-            all_lines.extend(messages)
-            all_html_lines.extend(html)
-        if not all_lines and not all_html_lines:
-            return
-        all_html_lines.append('')
-        all_html_lines.append('<a href="http://nyc-restaurant-grades.appspot.com/home">Manage Subscriptions</a>')
-        body = "\n".join(all_lines)
-        htmlbody = "<br>".join(all_html_lines)
-        subject = 'Restaurant Grades Updated!'
-        mail.send_mail('notifier@nyc-restaurant-grades.appspotmail.com',
-                       user.email, subject, body, html=htmlbody)
-        print body
-        print htmlbody
-        user.last_notified = datetime.now()
-        user.put()
+def update_from_bulk_export(source=None):
+    """
+    Refresh the subscribed restaurants from the open data export.
+    Reading the export takes longer than a request may, so this runs
+    as a task.
+    """
+    used = RestaurantSubscribers.used()
+    stream = open_bulk_export(source)
+    try:
+        updates = list(iter_bulk_restaurants(stream, camis=used))
+    finally:
+        stream.close()
+    restaurants = get_in_batches(
+        [Restaurant.make_key(camis) for camis in used])
+    UpdateRestaurantPage().update_restaurants(
+        [r for r in restaurants if r is not None], updates=updates)
 
+def queue_bulk_update(source=None):
+    """
+    Queue update_from_bulk_export.  Task names are per-hour, so asking
+    again while one is queued does nothing.
+    """
+    try:
+        deferred.defer(update_from_bulk_export, source,
+                       _name='bulk-update-%s' %
+                       datetime.now().strftime('%Y%m%d%H'))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+class NotifyPage(webapp2.RequestHandler):
     def get(self):
         action = self.request.get('action')
         goto   = self.request.get('goto')
         if goto is None:
             goto = '/notify'
         if action == "notify_all":
-            users = User.all()
-            for user in users:
-                self.notify_user(user)
+            if self.request.get('executor') == 'local':
+                executor = LocalExecutor()
+            else:
+                executor = TaskQueueExecutor()
+            notify_all(executor)
+            self.redirect(goto)
+        elif action == "start_job":
+            start_job_request(self, start_notify_job)
             self.redirect(goto)
         elif action == "notify_user":
             user_id = self.request.get('user')
             if user_id is not None and user_id != '':
                 user = db.get(User.make_key(user_id))
                 if user is not None:
-                    self.notify_user(user)
+                    notify_user(user)
             self.redirect(goto)
         else:
             user_id = self.request.get('user')
@@ -603,15 +4336,15 @@ class NotifyPage(webapp2.RequestHandler):
                 goto = '/notify'
             display_users = []
             for user in users:
-                subscriptions = Subscription.all().ancestor(user.key())
+                subscriptions = prefetch_subscriptions(
+                    Subscription.all().ancestor(user.key()), user)
                 display_user = {'user_id': user.key().id_or_name()
                                 ,'email': user.email
                                 ,'last_notified': user.last_notified
-                                ,'subscriptions': [s for s in subscriptions]
+                                ,'subscriptions': subscriptions
                                 }
                 display_users.append(display_user)
-            template = jinja_environment.get_template('notify.html')
-            self.response.out.write(template.render({
+            self.response.out.write(render_template('notify.html', {
                 'users': display_users,
                 'logout_url': gusers.create_logout_url('/'),
                 'goto': goto
@@ -620,21 +4353,212 @@ class NotifyPage(webapp2.RequestHandler):
 class GotoRestaurantPage(webapp2.RequestHandler):
     def get(self):
         camis = self.request.get('camis')
-        template = jinja_environment.get_template('goto.html')
-        self.response.out.write(template.render({
-            'camis': camis,
+        self.response.out.write(page_cache.render(
+            'goto', (camis,),
+            lambda: render_template('goto.html', {
+                'camis': camis,
+                })))
+
+class CitywidePage(webapp2.RequestHandler):
+    def get(self):
+        self.response.out.write(page_cache.render(
+            'citywide', (page_cache.version(CITYWIDE_VERSION),),
+            self.render))
+
+    def render(self):
+        citywide = citywide_store.get()
+        if citywide is None:
+            return render_template('citywide.html', {
+                'citywide': None,
+                'logout_url': gusers.create_logout_url('/')
+                })
+        snapshot = snapshot_store.get()
+        worsened = []
+        for camis, prev_score, score in citywide.worsened():
+            record = snapshot.index.get(camis)
+            worsened.append((camis, record.name if record else camis,
+                             prev_score, score))
+        return render_template('citywide.html', {
+            'citywide': citywide,
+            'grades': [grade or 'None' for grade in sorted(citywide.grades)],
+            'percentiles': SCORE_PERCENTILES,
+            'by_zipcode': citywide.grade_distribution('zipcode'),
+            'by_cuisine': citywide.grade_distribution('cuisine'),
+            'zipcode_scores': citywide.score_percentiles('zipcode'),
+            'cuisine_scores': citywide.score_percentiles('cuisine'),
+            'trend': citywide.score_trend(),
+            'worsened': worsened,
+            'logout_url': gusers.create_logout_url('/')
+            })
+
+# Most camis looked up by one /api/restaurants request.
+API_MAX_CAMIS = DATASTORE_BATCH_SIZE
+# With refresh, a refresh is queued for each zipcode of stored
+# restaurants last checked longer ago than max_age, which defaults to
+# API_MAX_AGE and can't be less than API_MIN_AGE.
+API_MAX_AGE = timedelta(hours=24)
+API_MIN_AGE = timedelta(hours=1)
+
+def refresh_zipcode(zipcode):
+    """
+    Refresh the stored restaurants in zipcode.  Runs as a task.  The
+    citywide stats are left for the next snapshot, as patching them
+    from tasks running side by side could lose changes.
+    """
+    restaurants = list(Restaurant.all().filter('zipcode =', zipcode))
+    if restaurants:
+        run = RefreshRun(strategy='zipcode')
+        UpdateRestaurantPage().update_restaurants(restaurants, run=run)
+        run.put()
+
+def queue_zipcode_refresh(zipcode, now=None):
+    """
+    Queue a refresh of zipcode.  Tasks are named for the zipcode and
+    the API_MIN_AGE period, so each zipcode is refreshed at most once
+    a period however often it is asked for.
+    """
+    period = int(time.mktime((now or datetime.now()).timetuple()) //
+                 API_MIN_AGE.total_seconds())
+    try:
+        deferred.defer(refresh_zipcode, zipcode,
+                       _name='refresh-%d-%d' % (zipcode, period))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+def restaurant_json(camis, r):
+    """
+    A stored Restaurant or a RestaurantRecord as a dict for JSON.
+    """
+    last_updated = getattr(r, 'last_updated', None)
+    return {'camis': camis, 'name': r.name, 'zipcode': r.zipcode,
+            'street': r.street, 'cuisine': r.cuisine, 'grade': r.grade,
+            'score': r.score,
+            'last_inspected': (r.last_inspected.isoformat()
+                               if r.last_inspected else None),
+            'last_updated': last_updated.isoformat() if last_updated else None}
+
+class RestaurantsApi(webapp2.RequestHandler):
+    """
+    Look up many restaurants at once, as JSON.  Takes camis, either
+    repeated or comma-separated, as query parameters or in a JSON
+    body {"camis": [...], "refresh": true, "max_age": seconds}.
+
+    Subscribed restaurants come from the datastore with one batch get,
+    the rest from the snapshot.  With refresh, signed-in users can
+    have stale stored restaurants refreshed in the background, a
+    zipcode at a time; the response has what we have now.  Responses
+    carry an ETag, so polling clients get a 304 when nothing changed.
+    """
+    def get(self):
+        camis = [c for value in self.request.get_all('camis')
+                 for c in value.split(',')]
+        max_age = self.request.get('max_age')
+        self.lookup(camis, self.request.get('refresh') in ('1', 'true'),
+                    int(max_age) if max_age.isdigit() else None)
+
+    def post(self):
+        if not self.request.headers.get('Content-Type', '').startswith(
+            'application/json'):
+            return self.get()
+        try:
+            body = json.loads(self.request.body)
+            camis = [unicode(c) for c in body.get('camis', [])]
+            max_age = body.get('max_age')
+            max_age = int(max_age) if max_age is not None else None
+        except (ValueError, TypeError, AttributeError):
+            return self.error_json(400, 'request body is not valid JSON')
+        self.lookup(camis, bool(body.get('refresh')), max_age)
+
+    def error_json(self, status, message):
+        self.response.set_status(status)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps({'error': message}))
+
+    def lookup(self, camis, refresh=False, max_age=None):
+        camis = sorted(set(c.strip() for c in camis if c.strip()))
+        if not camis:
+            return self.error_json(400, 'no camis given')
+        if len(camis) > API_MAX_CAMIS:
+            return self.error_json(400, 'at most %d camis at a time' %
+                                   API_MAX_CAMIS)
+        if refresh:
+            if gusers.get_current_user() is None:
+                return self.error_json(403, 'sign in to refresh')
+            max_age = (timedelta(seconds=max_age) if max_age is not None
+                       else API_MAX_AGE)
+            self.refresh_stale(camis, max(max_age, API_MIN_AGE))
+        snapshot_version = page_cache.version(SNAPSHOT_VERSION)
+        body = page_cache.render(
+            'api', (camis, page_cache.version(RESTAURANTS_VERSION),
+                    snapshot_version),
+            lambda: self.render(camis, snapshot_version))
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = 'private, max-age=0'
+        if self.request.headers.get('If-None-Match') == etag:
+            self.response.set_status(304)
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(body)
+
+    def refresh_stale(self, camis, max_age):
+        """
+        Queue refreshes of the zipcodes of stored restaurants in camis
+        that haven't been checked within max_age.
+        """
+        zipcodes = sorted(set(r.zipcode for r in db.get(
+            [Restaurant.make_key(c) for c in camis]) if r is not None))
+        digests = db.get([ZipcodeDigest.make_key(z) for z in zipcodes])
+        cutoff = datetime.now() - max_age
+        for zipcode, digest in zip(zipcodes, digests):
+            if (digest is None or digest.checked is None or
+                digest.checked < cutoff):
+                queue_zipcode_refresh(zipcode)
+
+    def render(self, camis, snapshot_version):
+        stored = db.get([Restaurant.make_key(c) for c in camis])
+        snapshot = None
+        restaurants = []
+        missing = []
+        for c, r in zip(camis, stored):
+            if r is None:
+                snapshot = (snapshot or
+                            snapshot_store.get_version(snapshot_version))
+                r = snapshot.index.get(c)
+            if r is None:
+                missing.append(c)
+            else:
+                restaurants.append(restaurant_json(c, r))
+        return json.dumps({'restaurants': restaurants, 'missing': missing},
+                          separators=(',', ':'), sort_keys=True)
+
+class StatsPage(webapp2.RequestHandler):
+    def get(self):
+        with stats.lock:
+            totals = stats.totals.report()
+            recent = list(stats.recent)
+        self.response.out.write(render_template('stats.html', {
+            'enabled': stats.enabled,
+            'requests': stats.requests,
+            'totals': totals,
+            'recent': recent,
+            'logout_url': gusers.create_logout_url('/')
             }))
 
 # -------------------------------------------------------------------
 # webapp
 
-app = webapp2.WSGIApplication(
+app = stats_middleware(webapp2.WSGIApplication(
     [('/home',        HomePage)
      ,('/find',       FindPage)
      ,('/updatesub',  UpdateSubscriptionPage)
      ,('/updateres',  UpdateRestaurantPage)
      ,('/notify',     NotifyPage)
      ,('/goto',       GotoRestaurantPage)
+     ,('/stats',      StatsPage)
+     ,('/stats/citywide', CitywidePage)
+     ,('/api/restaurants', RestaurantsApi)
      ],
-    debug=True)
+    debug=True))
 
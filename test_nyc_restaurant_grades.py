@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Tests for nyc_restaurant_grades, run against the SDK's testbed.
+
+The App Engine SDK needs to be on the PYTHONPATH, e.g.
+
+    PYTHONPATH=$SDK:$SDK/lib/webapp2-2.5.2:$SDK/lib/jinja2-2.6 \\
+        python test_nyc_restaurant_grades.py
+"""
+
+from __future__ import absolute_import, division, with_statement
+
+import functools
+import random
+import time
+import unittest
+from datetime import date, datetime
+from StringIO import StringIO
+
+import nyc_restaurant_grades as nrg
+from benchmark import (FakeAppEngine, FakeDohServer, ReplayDohClient,
+                       make_dwr_response, revise_response, synthetic_fixture)
+
+class FakeGoogleUser(object):
+    """
+    Stands in for the signed-in users.User that HomePage is given.
+    """
+    def __init__(self, user_id):
+        self._user_id = user_id
+
+    def user_id(self):
+        return self._user_id
+
+class PrefetchSubscriptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.app_engine = FakeAppEngine().__enter__()
+
+    def tearDown(self):
+        nrg.stats.bind(None)
+        self.app_engine.__exit__(None, None, None)
+
+    def make_user(self, user_id, subscriptions):
+        """
+        Put a user subscribed to that many restaurants.
+        """
+        user = nrg.User(key=nrg.User.make_key(user_id),
+                        email='%s@example.com' % user_id)
+        user.put()
+        restaurants = []
+        for i in range(subscriptions):
+            restaurants.append(nrg.Restaurant(
+                key=nrg.Restaurant.make_key(str(40000000 + i)),
+                name='RESTAURANT %d' % i, zipcode=10001, grade='A',
+                prev_grade='B', score=10 + i % 20, prev_score=12,
+                last_inspected=date(2012, 1, 1 + i % 28),
+                prev_inspected=date(2011, 1, 1),
+                last_updated=datetime(2012, 2, 1)))
+        nrg.put_in_batches(restaurants)
+        nrg.put_in_batches([nrg.Subscription(
+            parent=user, key_name=restaurant.key().name(),
+            restaurant=restaurant,
+            notify_grade_change='email',
+            notify_score_change='email',
+            notify_inspection_change='none')
+            for restaurant in restaurants])
+        return user
+
+    def count_rpcs(self, func, *args):
+        """
+        Run func, and return the RPCs it made by name.
+        """
+        collector = nrg.stats.start('test')
+        try:
+            func(*args)
+        finally:
+            nrg.stats.bind(None)
+        return dict((name, n) for name, n in collector.counters.items()
+                    if name.startswith('rpc.'))
+
+    def test_one_get_for_all_subscriptions(self):
+        user = self.make_user('user0', 200)
+        subscriptions = list(nrg.Subscription.all().ancestor(user))
+        def render():
+            for sub in nrg.prefetch_subscriptions(subscriptions):
+                sub.restaurant.name
+                sub.grade_notify_text()
+                sub.score_notify_text()
+                sub.inspection_notify_text()
+        self.assertEqual(self.count_rpcs(render),
+                         {'rpc.datastore_v3.Get': 1})
+
+    def test_home_page_rpcs_do_not_grow(self):
+        counts = []
+        for user_id, subscriptions in [('few', 2), ('many', 200)]:
+            user = self.make_user(user_id, subscriptions)
+            counts.append(self.count_rpcs(nrg.HomePage().render,
+                                          FakeGoogleUser(user_id), user,
+                                          'score'))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[1]['rpc.datastore_v3.Get'], 1)
+        self.assertEqual(counts[1]['rpc.datastore_v3.RunQuery'], 1)
+        self.assertNotIn('rpc.datastore_v3.Next', counts[1])
+
+class JobsTest(unittest.TestCase):
+    """
+    Update and notify jobs run by LocalJobRunner, with units killed
+    part way through.
+    """
+    ZIPCODES = [10001, 10002, 10003, 10004]
+    USERS = 10
+    SUBSCRIPTIONS_PER_USER = 8
+
+    def setUp(self):
+        self.app_engine = FakeAppEngine().__enter__()
+        self.doh_client = nrg.doh_client
+        self.interval = nrg.doh_rate_limiter.interval
+        fixture = synthetic_fixture(self.ZIPCODES, 10)
+        nrg.doh_rate_limiter.interval = 0
+        nrg.doh_client = ReplayDohClient(dict(
+            (zipcode, revise_response(response, 0.5, zipcode))
+            for zipcode, response in fixture.items()))
+        records = [nrg.RestaurantRecord.from_dwr(fields)
+                   for response in fixture.values()
+                   for fields in nrg.iter_restaurants(
+                       StringIO(response), fields=nrg.DWR_FIELDS)]
+        restaurants = [nrg.Restaurant.from_record(record)
+                       for record in records]
+        nrg.put_in_batches(restaurants)
+        for i in range(self.USERS):
+            user_id = 'user%d' % i
+            user = nrg.User(key=nrg.User.make_key(user_id),
+                            email='%s@example.com' % user_id)
+            user.put()
+            chosen = random.Random(i).sample(restaurants,
+                                             self.SUBSCRIPTIONS_PER_USER)
+            nrg.subscribe_all(user, [nrg.Subscription(
+                parent=user, key_name=restaurant.key().name(),
+                restaurant=restaurant,
+                notify_grade_change='email',
+                notify_score_change='email',
+                notify_inspection_change='email')
+                for restaurant in chosen])
+
+    def tearDown(self):
+        nrg.doh_client = self.doh_client
+        nrg.doh_rate_limiter.interval = self.interval
+        self.app_engine.__exit__(None, None, None)
+
+    def run_job(self, start, kill_rate):
+        # With seed 1, the first unit is killed before its work, and a
+        # later one after it.
+        runner = nrg.LocalJobRunner(kill_rate=kill_rate, seed=1,
+                                    transport=nrg.CaptureTransport())
+        job = start(schedule=runner.push)
+        # run_all raises AssertionError if any mail went out twice.
+        runner.run_all()
+        self.assertTrue(nrg.db.get(job.key()).finished is not None)
+        self.assertEqual(nrg.pending_units(job.key()).count(), 0)
+        return runner
+
+    def test_killed_jobs_finish_without_duplicate_mail(self):
+        updater = self.run_job(nrg.start_update_job, 0.3)
+        self.assertTrue(updater.kills > 0)
+        events = list(nrg.events_after(0))
+        self.assertTrue(events)
+        self.assertEqual(sorted(event.sequence for event in events),
+                         range(1, len(events) + 1))
+        changed = set(event.camis for event in events)
+        expected = set(
+            '%s@example.com' % key.parent().name()
+            for key in nrg.Subscription.all(keys_only=True)
+            if key.name() in changed)
+
+        notifier = self.run_job(
+            functools.partial(nrg.start_notify_job, shard_size=2), 0.3)
+        self.assertTrue(notifier.kills > 0)
+        sent = [to for to, body in notifier.transport.sent]
+        self.assertEqual(sorted(sent), sorted(expected))
+
+class DohClientTest(unittest.TestCase):
+    """
+    DohClient against the fake DoH site, with failures injected.
+    """
+    PER_ZIPCODE = 20
+
+    def setUp(self):
+        self.server = FakeDohServer(0, self.PER_ZIPCODE, stall=1.0)
+        self.delays = []
+        self.breaker = nrg.CircuitBreaker(threshold=5, cooldown=0.2)
+        self.client = nrg.DohClient(read_timeout=0.3, retries=2,
+                                    backoff=1.0, breaker=self.breaker,
+                                    sleep=self.delays.append)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, zipcode=10001):
+        """
+        The camis the client reads from the server for zipcode.
+        """
+        params = {'c0-param0': 'string:zipCode :_%s' % zipcode}
+        return self.client.post(
+            self.server.url, params,
+            lambda response: [fields['restCamis'] for fields in
+                              nrg.iter_restaurants(response)])
+
+    def expected(self, zipcode=10001):
+        response = make_dwr_response(self.PER_ZIPCODE, zipcodes=[zipcode],
+                                     seed=zipcode)
+        return [fields['restCamis']
+                for fields in nrg.iter_restaurants(StringIO(response))]
+
+    def test_gzip(self):
+        self.assertEqual(self.fetch(), self.expected())
+        self.assertEqual(self.server.gzipped, 1)
+
+    def test_retries_with_backoff(self):
+        self.server.faults = ['error', 'error']
+        self.assertEqual(self.fetch(), self.expected())
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(len(self.delays), 2)
+        # Jitter is within half the delay either way.
+        self.assertTrue(0.5 <= self.delays[0] <= 1.5)
+        self.assertTrue(1.0 <= self.delays[1] <= 3.0)
+
+    def test_gives_up(self):
+        self.server.faults = ['error'] * 3
+        self.assertRaises(nrg.DohError, self.fetch)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_retries_stalled_body(self):
+        self.server.faults = ['stall']
+        self.assertEqual(self.fetch(), self.expected())
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(len(self.delays), 1)
+
+    def test_replaces_stale_connection(self):
+        self.server.faults = ['close']
+        self.assertEqual(self.fetch(), self.expected())
+        self.assertEqual(self.fetch(10002), self.expected(10002))
+        # The second request found the kept-alive connection closed,
+        # and went straight to a new one.
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.delays, [])
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_reuses_connection(self):
+        self.fetch()
+        self.fetch(10002)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_circuit_breaker(self):
+        self.breaker.threshold = 2
+        self.client.retries = 1
+        self.server.faults = ['error'] * 3
+        self.assertRaises(nrg.DohError, self.fetch)
+        # Open: nothing is sent.
+        self.assertRaises(nrg.CircuitOpenError, self.fetch)
+        self.assertEqual(self.server.requests, 2)
+        # Half open after the cooldown: one request is let through,
+        # and when it fails the circuit opens again.
+        time.sleep(self.breaker.cooldown)
+        self.client.retries = 0
+        self.assertRaises(nrg.DohError, self.fetch)
+        self.assertEqual(self.server.requests, 3)
+        self.assertRaises(nrg.CircuitOpenError, self.fetch)
+        # Once a request succeeds, it closes.
+        time.sleep(self.breaker.cooldown)
+        self.assertEqual(self.fetch(), self.expected())
+        self.assertEqual(self.breaker.opened, None)
+        self.assertEqual(self.breaker.failures, 0)
+
+if __name__ == '__main__':
+    unittest.main()